@@ -0,0 +1,396 @@
+import os, sys, logging, time
+from contextlib import contextmanager
+
+import config, codec
+from rwlock import RWLock
+from cursors import Query, Cursors
+from cache import RecentCache, MIN_KEY, MAX_SEQ
+from ingest import Ingest
+from syncs import SyncCursors
+from subscriptions import Subscriptions
+from codec import Codec
+
+log = logging.getLogger("storage")
+BACKENDS = ("sqlite", "segments", "log")
+
+
+class StorageTimeout(Exception): pass
+
+
+def create():
+    name = config.getSub("storage").get("backend", cast = config.choice(*BACKENDS), default = "sqlite")
+    if name == "segments":
+        from segments import SegmentStorage
+        return SegmentStorage()
+    elif name == "log":
+        from logstore import LogStorage
+        return LogStorage()
+    else:
+        from storage import Storage
+        return Storage()
+
+
+class Backend:
+    """Storage surface used by Eris, bluetooth connections and the Retriever.
+
+    Backend holds everything the storage engines share: the ingest queue,
+    the reader/writer lock, parked query cursors and payload codecs. An engine
+    implements the hooks below; write receives (timestamp, codec, data) rows
+    and returns their seq numbers, and page returns (timestamp, data, codec, seq)
+    rows, newest first, where (timestamp, seq) uniquely orders packets.
+    Ranges recent enough to be held by the RecentCache never reach the engine.
+    Every change of the stored packets bumps `version`, which readers may use
+    to tell whether what they derived from earlier reads is still current.
+    Committed packets are also handed to the subscriptions registered with
+    get, resume or subscribe, before the write lock is released.
+
+        open()                      open or create the store
+        closeStore()                release files and connections
+        write(packets)              store encoded packets, return seqs (write lock held)
+        count(since, to, limit)     packets in a range, capped by limit (read lock held)
+        page(since, to, after, n)   up to n packets of a range below the after key (read lock held)
+        remove(since, to)           delete an inclusive range (write lock held)
+        vaccum()                    enforce capacity, calling forget() for removed packets
+        totals()                    rows, bytes, min_ts and max_ts
+        size()                      storage size in KiB
+    """
+    def __init__(self):
+        self.lock = RWLock()
+        self.version = 0
+
+        conf = config.getSub("storage")
+        self.capacity = conf.get("capacity", cast = config.positiveInt, default = 2048)
+        self.capacityPackets = conf.get("capacity_packets", cast = config.nonNegativeInt, default = 0)
+        self.capacityBytes = conf.get("capacity_bytes", cast = config.nonNegativeInt, default = 0)
+        self.vacPercent = conf.get("vacuum_percent", cast = config.positivePercent, default = 20.0) / 100
+        self.timeout = conf.get("timeout", cast = config.positiveFloat, default = 10.0)
+        flushPackets = conf.get("flush_packets", cast = config.positiveInt, default = 256)
+        flushBytes = conf.get("flush_bytes", cast = config.positiveInt, default = 1024 * 1024)
+        flushWindow = conf.get("flush_ms", cast = config.nonNegativeFloat, default = 50.0) / 1000
+        self.codec = Codec(conf.get("codec", cast = config.choice(*codec.NAMES), default = "raw"),
+                           conf.get("codec_level", cast = codec.level, default = 6),
+                           conf.get("codec_min_bytes", cast = config.nonNegativeInt, default = 64))
+        maxCursors = conf.get("max_cursors", cast = config.positiveInt, default = 64)
+        cursorTtl = conf.get("cursor_ttl", cast = config.positiveFloat, default = 300.0)
+        self.cache = RecentCache(conf.get("recent_cache_kib", cast = config.nonNegativeInt, default = 1024) * 1024)
+        self.configure(conf)
+
+        try:
+            self.open()
+            self.vaccum()
+            self.warm()
+            self.syncs = SyncCursors(self.syncFile(), self.timeout)
+        except Exception:
+            log.critical("Failed to initialize storage", exc_info = 1)
+            sys.exit(1)
+
+        self.cursors = Cursors(maxCursors, cursorTtl)
+        self.subscriptions = Subscriptions()
+        self.ingest = Ingest(self.insert, flushPackets, flushBytes, flushWindow)
+        self.ingest.start()
+        log.info("Storage initialized")
+
+    def configure(self, conf):
+        pass
+
+    def open(self):
+        raise NotImplementedError()
+
+    def closeStore(self):
+        raise NotImplementedError()
+
+    def write(self, packets):
+        raise NotImplementedError()
+
+    def count(self, since, to, limit):
+        raise NotImplementedError()
+
+    def page(self, since, to, after, n):
+        raise NotImplementedError()
+
+    def remove(self, since, to):
+        raise NotImplementedError()
+
+    def vaccum(self):
+        raise NotImplementedError()
+
+    def totals(self):
+        raise NotImplementedError()
+
+    def size(self):
+        raise NotImplementedError()
+
+    def overCapacity(self):
+        stats = self.totals()
+        size = self.size()
+        log.debug("Size: {}, Packets: {}, Bytes: {}".format(size, stats["rows"], stats["bytes"]))
+        return (size >= self.capacity or
+                0 < self.capacityPackets <= stats["rows"] or
+                0 < self.capacityBytes <= stats["bytes"])
+
+    def put(self, packets, sync = False):
+        """Queues packets for insertion by the ingest thread.
+
+        Returns an Ack which can be waited on for the commit outcome, or with
+        sync = True waits for it and returns whether the packets were stored.
+        """
+        now = long(time.time() * 1000)
+        packets = [(now if t is None else long(t), d) for t, d in packets]
+        ack = self.ingest.put(packets)
+        return ack.wait() if sync else ack
+
+    def insert(self, packets):
+        log.info("Inserting {} packets".format(len(packets)))
+        try:
+            encoded = self.encode(packets)
+            with self.writing():
+                self.version += 1
+                seqs = self.write(encoded)
+                self.cache.add((t, seq, d) for (t, d), seq in zip(packets, seqs))
+                self.subscriptions.notify(packets)
+        except Exception:
+            log.error("Failed to insert packets", exc_info = 1)
+            return False
+        self.vaccum()
+        return True
+
+    def encode(self, packets):
+        return [(t, ) + self.codec.encode(d) for t, d in packets]
+
+    def get(self, since = 0, to = 0, limit = 0, subscription = None):
+        """Opens a paginated query over (since, to), newest first.
+
+        Returns the cursor id to fetch from and the number of packets the query
+        will return, or (None, 0) on failure. Pages start below the newest
+        packet counted, so packets stored later never displace counted ones.
+        A subscription is registered along with the query: it is notified of
+        exactly the packets stored after the query was counted.
+        """
+        try:
+            to = long(to) if to > 0 else long(2 ** 63 - 1)
+            since = long(since)
+
+            log.info("Retrieving packets (since={}, to={}, limit={})".format(since, to, limit))
+
+            with self.reading():
+                if subscription is not None:
+                    self.subscriptions.add(subscription)
+                if self.cache.covers(since):
+                    count = self.cache.count(since, to, limit)
+                else:
+                    count = self.count(since, to, limit)
+                newest = self.newest(since, to) if count > 0 else None
+            if limit > 0:
+                count = min(count, limit)
+            if newest is None:
+                return self.cursors.add(Query(since, to, count)), count
+            return self.cursors.add(Query(since, to, count, newest[0], newest[1] + 1)), count
+
+        except Exception:
+            log.error("Failed to retrieve packets", exc_info = 1)
+            return None, 0
+
+    def newest(self, since, to):
+        """(timestamp, seq) key of the newest packet of (since, to), or None
+        (read lock held)."""
+        rows = self.cache.page(since, to, (to, 0), 1)
+        if rows is None:
+            rows = self.page(since, to, (to, 0), 1)
+        return (rows[0][0], rows[0][3]) if rows else None
+
+    def resume(self, token, subscription = None):
+        """Reopens a query from a continuation token returned by token().
+        Returns the cursor id and the number of packets left."""
+        try:
+            query = Query.parse(token)
+            if subscription is not None:
+                self.subscribe(subscription)
+            log.info("Resuming packets retrieval [{}]".format(token))
+            return self.cursors.add(query), query.remaining
+        except Exception:
+            log.error("Failed to resume retrieval [{}]".format(token), exc_info = 1)
+            return None, 0
+
+    def subscribe(self, subscription):
+        """Starts notifying subscription of the packets stored from now on."""
+        with self.reading():
+            self.subscriptions.add(subscription)
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.remove(subscription)
+
+    def token(self, connId):
+        """Continuation token of an open cursor, or None if it is unknown."""
+        query = self.cursors.get(connId)
+        return query.token() if query is not None else None
+
+    def fetch(self, connId, n = 1, encoded = False):
+        """Next n packets of a query as (timestamp, data) pairs. With encoded
+        the data is returned as a protobuf Packet.data field made of str and
+        buffer segments (see wire), without copying stored payloads."""
+        query = self.cursors.get(connId)
+        if query is None:
+            return []
+
+        try:
+            result = self.nextPage(query, n, encoded)
+            if len(result) == 0:
+                self.closeConn(connId)
+                return []
+            else:
+                log.debug("Fetched {} packets".format(len(result)))
+                return result
+        except Exception:
+            log.exception("Failed to fetch packets")
+            self.closeConn(connId)
+            return []
+
+    def seek(self, connId, token):
+        """Moves an open query to the position of a continuation token taken
+        from an identical query, as if the packets in between were fetched."""
+        query = self.cursors.get(connId)
+        if query is None:
+            return
+        position = Query.parse(token)
+        query.advance(position.after(), query.remaining - position.remaining)
+
+    def fetchall(self, connId, pageSize = 1000):
+        query = self.cursors.remove(connId)
+        if query is None:
+            return []
+
+        try:
+            result = []
+            while True:
+                packets = self.nextPage(query, pageSize)
+                if len(packets) == 0:
+                    break
+                result.extend(packets)
+            log.debug("Fetched {} packets".format(len(result)))
+            return result
+        except Exception:
+            log.exception("Failed to fetch packets")
+            return []
+
+    def nextPage(self, query, n, encoded = False):
+        n = min(n, query.remaining)
+        if n <= 0:
+            return []
+        with self.reading():
+            rows = self.cache.page(query.since, query.to, query.after(), n)
+            if rows is None:
+                rows = self.page(query.since, query.to, query.after(), n)
+        if len(rows) > 0:
+            query.advance((rows[-1][0], rows[-1][3]), len(rows))
+        if encoded:
+            return [(t, Codec.field(c, d)) for t, d, c, _ in rows]
+        return self.debuffer(rows)
+
+    def closeConn(self, connId):
+        self.cursors.remove(connId)
+
+    def release(self, connId):
+        self.closeConn(connId)
+
+    def delete(self, since, to):
+        try:
+            to = long(to) if to > 0 else long(2 ** 63 - 1)
+            since = long(since)
+            log.info("Deleting packets (since={}, to={})".format(since, to))
+
+            with self.writing():
+                self.version += 1
+                log.info("Deleted {} packets".format(self.remove(since, to)))
+                self.cache.remove(since, to)
+        except:
+            log.exception("Could not delete sent packets")
+
+    def lastSync(self, address):
+        """Newest timestamp the client at address confirmed receiving, or None."""
+        return self.syncs.get(address)
+
+    def synced(self, address, timestamp):
+        """Records that the client at address completed a transfer of packets
+        up to timestamp."""
+        try:
+            if self.syncs.advance(address, long(timestamp)):
+                log.info("Client {} synced up to {}".format(address, timestamp))
+        except:
+            log.exception("Could not record sync of client {}".format(address))
+
+    def forget(self, key):
+        """Called by engines, with the write lock held, when retention removed
+        every packet up to key."""
+        self.version += 1
+        self.cache.forget(key)
+
+    def rowcount(self):
+        return self.totals()["rows"]
+
+    def warm(self):
+        """Fills the recent cache with the newest stored packets."""
+        packets = []
+        size = 0
+        floor = MIN_KEY
+        after = (long(2 ** 63 - 1), MAX_SEQ)
+        while size < self.cache.capacity and floor == MIN_KEY:
+            rows = self.page(MIN_KEY[0], long(2 ** 63 - 1), after, 256)
+            if len(rows) == 0:
+                break
+            for t, d, c, seq in rows:
+                data = Codec.decode(c, d)
+                if size + len(data) > self.cache.capacity:
+                    floor = (t, seq)
+                    break
+                packets.append((t, seq, data))
+                size += len(data)
+            after = (rows[-1][0], rows[-1][3])
+        else:
+            if size >= self.cache.capacity:
+                floor = after
+        packets.reverse()
+        self.cache.load(packets, floor)
+        log.info("Cached {} recent packets ({} bytes)".format(len(packets), size))
+
+    def close(self):
+        self.ingest.kill()
+        self.ingest.join()
+        self.cursors.clear()
+        self.syncs.close()
+        self.closeStore()
+        log.info("Storage closed")
+
+    @contextmanager
+    def reading(self):
+        if not self.lock.acquireRead(self.timeout):
+            raise StorageTimeout("Storage request timed out")
+        try:
+            yield
+        finally:
+            self.lock.releaseRead()
+
+    @contextmanager
+    def writing(self):
+        if not self.lock.acquireWrite(self.timeout):
+            raise StorageTimeout("Storage request timed out")
+        try:
+            yield
+        finally:
+            self.lock.releaseWrite()
+
+    @staticmethod
+    def syncFile():
+        return os.path.join(config.workDir, "sync.db")
+
+    @staticmethod
+    def spanned(stats, since, to):
+        """Packet count of stats if (since, to) covers every packet it
+        describes, otherwise None."""
+        if stats["rows"] == 0:
+            return 0
+        if stats["min_ts"] is not None and since < stats["min_ts"] and stats["max_ts"] < to:
+            return stats["rows"]
+        return None
+
+    def debuffer(self, result):
+        return [(t, Codec.decode(c, d)) for t, d, c, _ in result]
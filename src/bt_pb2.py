@@ -11,10 +11,32 @@ from google.protobuf import descriptor_pb2
 DESCRIPTOR = descriptor.FileDescriptor(
   name='bt.proto',
   package='rtkaczyk.eris.bluetooth',
-  serialized_pb='\n\x08\x62t.proto\x12\x17rtkaczyk.eris.bluetooth\"T\n\x07Request\x12\x0b\n\x03\x66rm\x18\x01 \x01(\x06\x12\n\n\x02to\x18\x02 \x01(\x06\x12\r\n\x05limit\x18\x03 \x01(\x05\x12\r\n\x05\x62\x61tch\x18\x04 \x01(\x05\x12\x12\n\x04\x66ull\x18\x05 \x01(\x08:\x04true\"\x97\x01\n\x08Response\x12\x0b\n\x03\x66rm\x18\x01 \x01(\x06\x12\n\n\x02to\x18\x02 \x01(\x06\x12\x30\n\x07packets\x18\x03 \x03(\x0b\x32\x1f.rtkaczyk.eris.bluetooth.Packet\x12\x11\n\tnoPackets\x18\x04 \x01(\x05\x12-\n\x05\x65rror\x18\x05 \x01(\x0b\x32\x1e.rtkaczyk.eris.bluetooth.Error\")\n\x06Packet\x12\x11\n\ttimestamp\x18\x01 \x01(\x06\x12\x0c\n\x04\x64\x61ta\x18\x02 \x02(\x0c\"\x96\x01\n\x05\x45rror\x12\x31\n\x04\x63ode\x18\x01 \x02(\x0e\x32#.rtkaczyk.eris.bluetooth.Error.Code\x12\x13\n\x0b\x64\x65scription\x18\x02 \x01(\t\"E\n\x04\x43ode\x12\x14\n\x10\x43ONNECTION_ERROR\x10\x00\x12\x13\n\x0fINVALID_REQUEST\x10\x01\x12\x12\n\x0eINTERNAL_ERROR\x10\x02\x42\x0c\x42\nBtMessages')
+  serialized_pb='\n\x08\x62t.proto\x12\x17rtkaczyk.eris.bluetooth\"\xf5\x01\n\x07Request\x12\x0b\n\x03\x66rm\x18\x01 \x01(\x06\x12\n\n\x02to\x18\x02 \x01(\x06\x12\r\n\x05limit\x18\x03 \x01(\x05\x12\r\n\x05\x62\x61tch\x18\x04 \x01(\x05\x12\x12\n\x04\x66ull\x18\x05 \x01(\x08:\x04true\x12\x10\n\x08\x61\x63kEvery\x18\x06 \x01(\x05\x12\x0e\n\x06resume\x18\x07 \x01(\x08\x12\x36\n\x06\x63odecs\x18\x08 \x03(\x0e\x32&.rtkaczyk.eris.bluetooth.Request.Codec\x12\x11\n\tsinceLast\x18\t \x01(\x08\x12\x11\n\tsubscribe\x18\n \x01(\x08\"\x1f\n\x05\x43odec\x12\t\n\x05PLAIN\x10\x00\x12\x0b\n\x07\x44\x45\x46LATE\x10\x01\"\xe2\x01\n\x08Response\x12\x0b\n\x03\x66rm\x18\x01 \x01(\x06\x12\n\n\x02to\x18\x02 \x01(\x06\x12\x30\n\x07packets\x18\x03 \x03(\x0b\x32\x1f.rtkaczyk.eris.bluetooth.Packet\x12\x11\n\tnoPackets\x18\x04 \x01(\x05\x12-\n\x05\x65rror\x18\x05 \x01(\x0b\x32\x1e.rtkaczyk.eris.bluetooth.Error\x12\x12\n\ncompressed\x18\x06 \x01(\x0c\x12\x35\n\x05\x63odec\x18\x07 \x01(\x0e\x32&.rtkaczyk.eris.bluetooth.Request.Codec\")\n\x06Packet\x12\x11\n\ttimestamp\x18\x01 \x01(\x06\x12\x0c\n\x04\x64\x61ta\x18\x02 \x02(\x0c\"8\n\x03\x41\x63k\x12\x11\n\ttimestamp\x18\x01 \x01(\x06\x12\x10\n\x08received\x18\x02 \x01(\x05\x12\x0c\n\x04last\x18\x03 \x01(\x08\"\x96\x01\n\x05\x45rror\x12\x31\n\x04\x63ode\x18\x01 \x02(\x0e\x32#.rtkaczyk.eris.bluetooth.Error.Code\x12\x13\n\x0b\x64\x65scription\x18\x02 \x01(\t\"E\n\x04\x43ode\x12\x14\n\x10\x43ONNECTION_ERROR\x10\x00\x12\x13\n\x0fINVALID_REQUEST\x10\x01\x12\x12\n\x0eINTERNAL_ERROR\x10\x02\x42\x0c\x42\nBtMessages')
 
 
 
+_REQUEST_CODEC = descriptor.EnumDescriptor(
+  name='Codec',
+  full_name='rtkaczyk.eris.bluetooth.Request.Codec',
+  filename=None,
+  file=DESCRIPTOR,
+  values=[
+    descriptor.EnumValueDescriptor(
+      name='PLAIN', index=0, number=0,
+      options=None,
+      type=None),
+    descriptor.EnumValueDescriptor(
+      name='DEFLATE', index=1, number=1,
+      options=None,
+      type=None),
+  ],
+  containing_type=None,
+  options=None,
+  serialized_start=252,
+  serialized_end=283,
+)
+
+
 _ERROR_CODE = descriptor.EnumDescriptor(
   name='Code',
   full_name='rtkaczyk.eris.bluetooth.Error.Code',
@@ -36,8 +58,8 @@ _ERROR_CODE = descriptor.EnumDescriptor(
   ],
   containing_type=None,
   options=None,
-  serialized_start=402,
-  serialized_end=471,
+  serialized_start=697,
+  serialized_end=766,
 )
 
 
@@ -83,17 +105,53 @@ _REQUEST = descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    descriptor.FieldDescriptor(
+      name='ackEvery', full_name='rtkaczyk.eris.bluetooth.Request.ackEvery', index=5,
+      number=6, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='resume', full_name='rtkaczyk.eris.bluetooth.Request.resume', index=6,
+      number=7, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='codecs', full_name='rtkaczyk.eris.bluetooth.Request.codecs', index=7,
+      number=8, type=14, cpp_type=8, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='sinceLast', full_name='rtkaczyk.eris.bluetooth.Request.sinceLast', index=8,
+      number=9, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='subscribe', full_name='rtkaczyk.eris.bluetooth.Request.subscribe', index=9,
+      number=10, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
   nested_types=[],
   enum_types=[
+    _REQUEST_CODEC,
   ],
   options=None,
   is_extendable=False,
   extension_ranges=[],
-  serialized_start=37,
-  serialized_end=121,
+  serialized_start=38,
+  serialized_end=283,
 )
 
 
@@ -139,6 +197,20 @@ _RESPONSE = descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    descriptor.FieldDescriptor(
+      name='compressed', full_name='rtkaczyk.eris.bluetooth.Response.compressed', index=5,
+      number=6, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value="",
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='codec', full_name='rtkaczyk.eris.bluetooth.Response.codec', index=6,
+      number=7, type=14, cpp_type=8, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
@@ -148,8 +220,8 @@ _RESPONSE = descriptor.Descriptor(
   options=None,
   is_extendable=False,
   extension_ranges=[],
-  serialized_start=124,
-  serialized_end=275,
+  serialized_start=286,
+  serialized_end=512,
 )
 
 
@@ -183,8 +255,50 @@ _PACKET = descriptor.Descriptor(
   options=None,
   is_extendable=False,
   extension_ranges=[],
-  serialized_start=277,
-  serialized_end=318,
+  serialized_start=514,
+  serialized_end=555,
+)
+
+
+_ACK = descriptor.Descriptor(
+  name='Ack',
+  full_name='rtkaczyk.eris.bluetooth.Ack',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    descriptor.FieldDescriptor(
+      name='timestamp', full_name='rtkaczyk.eris.bluetooth.Ack.timestamp', index=0,
+      number=1, type=6, cpp_type=4, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='received', full_name='rtkaczyk.eris.bluetooth.Ack.received', index=1,
+      number=2, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    descriptor.FieldDescriptor(
+      name='last', full_name='rtkaczyk.eris.bluetooth.Ack.last', index=2,
+      number=3, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  extension_ranges=[],
+  serialized_start=557,
+  serialized_end=613,
 )
 
 
@@ -219,17 +333,21 @@ _ERROR = descriptor.Descriptor(
   options=None,
   is_extendable=False,
   extension_ranges=[],
-  serialized_start=321,
-  serialized_end=471,
+  serialized_start=616,
+  serialized_end=766,
 )
 
+_REQUEST.fields_by_name['codecs'].enum_type = _REQUEST_CODEC
+_REQUEST_CODEC.containing_type = _REQUEST;
 _RESPONSE.fields_by_name['packets'].message_type = _PACKET
 _RESPONSE.fields_by_name['error'].message_type = _ERROR
+_RESPONSE.fields_by_name['codec'].enum_type = _REQUEST_CODEC
 _ERROR.fields_by_name['code'].enum_type = _ERROR_CODE
 _ERROR_CODE.containing_type = _ERROR;
 DESCRIPTOR.message_types_by_name['Request'] = _REQUEST
 DESCRIPTOR.message_types_by_name['Response'] = _RESPONSE
 DESCRIPTOR.message_types_by_name['Packet'] = _PACKET
+DESCRIPTOR.message_types_by_name['Ack'] = _ACK
 DESCRIPTOR.message_types_by_name['Error'] = _ERROR
 
 class Request(message.Message):
@@ -250,6 +368,12 @@ class Packet(message.Message):
   
   # @@protoc_insertion_point(class_scope:rtkaczyk.eris.bluetooth.Packet)
 
+class Ack(message.Message):
+  __metaclass__ = reflection.GeneratedProtocolMessageType
+  DESCRIPTOR = _ACK
+  
+  # @@protoc_insertion_point(class_scope:rtkaczyk.eris.bluetooth.Ack)
+
 class Error(message.Message):
   __metaclass__ = reflection.GeneratedProtocolMessageType
   DESCRIPTOR = _ERROR
@@ -1,11 +1,14 @@
-import bluetooth as bt
 import threading, logging, select, time
 
-import config
-from connection import Connection, getConnections
+import config, codec, bt_pb2, transport
+from connection import Connection, getConnections, reject
+from reactor import Reactor
+from prefetch import BatchSizer, Deflater, FrameCache
+from checkpoints import Checkpoints
 
 
 log = logging.getLogger("btserver")
+MODES = ("threaded", "reactor")
 
 
 class BtServer(threading.Thread):
@@ -14,10 +17,25 @@ class BtServer(threading.Thread):
         self.storage = storage
         
         conf = config.getSub("bluetooth")
-        self.channel = conf.get("rfcomm_channel", cast = config.channel, default = 2)
+        self.transport = transport.create(conf)
         self.batch = conf.get("batch", cast = config.positiveInt, default = 100)
         self.timeout = conf.get("timeout", cast = config.positiveFloat, default = 10.0)
         self.delSent = conf.get("delete_sent", cast = config.boolean, default = False)
+        self.mode = conf.get("mode", cast = config.choice(*MODES), default = "threaded")
+        self.maxSessions = conf.get("max_sessions", cast = config.positiveInt, default = 8)
+        self.workers = conf.get("workers", cast = config.positiveInt, default = 2)
+        self.prefetch = conf.get("prefetch", cast = config.nonNegativeInt, default = 2)
+        self.adaptive = conf.get("adaptive_batch", cast = config.boolean, default = False)
+        self.frameBytes = conf.get("frame_kib", cast = config.positiveInt, default = 64) * 1024
+        self.frameSeconds = conf.get("frame_ms", cast = config.positiveFloat, default = 250.0) / 1000
+        self.maxBatch = conf.get("max_batch", cast = config.positiveInt, default = 1000)
+        self.deflate = conf.get("deflate", cast = config.boolean, default = True)
+        self.deflateLevel = conf.get("deflate_level", cast = codec.level, default = 6)
+        frameCache = conf.get("frame_cache_kib", cast = config.nonNegativeInt, default = 1024) * 1024
+        self.frameCache = FrameCache(frameCache) if frameCache > 0 else None
+        self.checkpoints = Checkpoints(conf.get("max_checkpoints", cast = config.positiveInt, default = 64),
+                                       conf.get("checkpoint_ttl", cast = config.positiveFloat, default = 600.0))
+        self.subscribeBuffer = conf.get("subscribe_buffer_kib", cast = config.positiveInt, default = 1024) * 1024
         
         self.running = True
         self.server_sock = None
@@ -27,16 +45,9 @@ class BtServer(threading.Thread):
         while self.running:
             self.server_sock = None
             try:
-                self.server_sock = bt.BluetoothSocket(bt.RFCOMM)
-                self.server_sock.setblocking(0)
-                self.server_sock.bind(("", self.channel))
-                self.server_sock.listen(1)
-                
-                bt.advertise_service(self.server_sock, config.PNAME,
-                          service_classes = [bt.SERIAL_PORT_CLASS],
-                          profiles = [bt.SERIAL_PORT_PROFILE])
-                
-                log.info("Waiting for connections on RFCOMM channel [{}]".format(self.server_sock.getsockname()[1]))
+                self.server_sock = self.transport.listen(self.maxSessions)
+                if self.mode == "reactor":
+                    Reactor(self, self.server_sock).run()
                 while self.running:
                     readable, _, _ = select.select([self.server_sock], [], [], 0.1)
                     for s in readable:
@@ -45,9 +56,12 @@ class BtServer(threading.Thread):
                             log.info("Accepted connection from: " + str(client_info))
                             client_sock.setblocking(1)
                             client_sock.settimeout(self.timeout)
-                
-                            if self.running:
-                                conn = Connection(client_sock, self)
+                            self.transport.accepted(client_sock)
+                            
+                            if len(getConnections()) >= self.maxSessions:
+                                reject(client_sock, "Too many sessions")
+                            elif self.running:
+                                conn = Connection(client_sock, self, self.transport.address(client_info))
                                 conn.start()
             except:
                 if self.running:
@@ -56,10 +70,30 @@ class BtServer(threading.Thread):
             finally:
                 self.close()
 
+    def batchSizer(self, requested):
+        """Batch sizing for a transfer. A batch requested by the client is
+        kept fixed, otherwise the configured batch is used, adapted to packet
+        sizes and link throughput when adaptive_batch is on."""
+        if requested > 0:
+            return BatchSizer(requested)
+        return BatchSizer(self.batch, self.adaptive, self.frameBytes, self.frameSeconds, self.maxBatch)
+
+    def deflater(self, codecs):
+        """Compression of a transfer: the first of the codecs advertised by
+        the client which the server supports, or None to send Responses
+        plain, as to clients which advertise none."""
+        for c in codecs:
+            if c == bt_pb2.Request.PLAIN:
+                break
+            if c == bt_pb2.Request.DEFLATE and self.deflate:
+                return Deflater(c, self.deflateLevel)
+        return None
+
     def close(self):
         try:
             if self.server_sock is not None:
-                self.server_sock.close()
+                self.transport.close(self.server_sock)
+                self.server_sock = None
         except:
             pass
         
@@ -0,0 +1,84 @@
+from bisect import bisect_left, bisect_right, insort
+
+from codec import RAW
+
+MIN_KEY = (-2 ** 63, 0)
+MAX_SEQ = 2 ** 63 - 1
+
+
+class RecentCache:
+    """Byte-capped copy of the newest stored packets, decoded.
+
+    Entries are (timestamp, seq, data) kept in ascending (timestamp, seq)
+    order. The cache holds every stored packet whose key is above `floor`:
+    evicting the oldest entries, or forgetting packets removed by retention,
+    raises the floor, and packets stored below the floor are not cached.
+    A range starting at or above the floor timestamp is therefore complete
+    in memory. Callers serialize access with the storage lock.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = []
+        self.bytes = 0
+        self.floor = MIN_KEY
+
+    def add(self, packets):
+        """Caches (timestamp, seq, data) of newly stored packets."""
+        for ts, seq, data in packets:
+            if (ts, seq) <= self.floor:
+                continue
+            if not self.entries or (ts, seq) > self.entries[-1][:2]:
+                self.entries.append((ts, seq, data))
+            else:
+                insort(self.entries, (ts, seq, data))
+            self.bytes += len(data)
+        self.shrink()
+
+    def shrink(self):
+        n = 0
+        while self.bytes > self.capacity and n < len(self.entries):
+            self.bytes -= len(self.entries[n][2])
+            n += 1
+        if n > 0:
+            self.floor = self.entries[n - 1][:2]
+            del self.entries[:n]
+
+    def covers(self, since):
+        return since >= self.floor[0]
+
+    def remove(self, since, to):
+        """Drops cached packets with since <= timestamp <= to."""
+        lo = bisect_left(self.entries, (since, ))
+        hi = bisect_left(self.entries, (to + 1, ))
+        self.bytes -= sum(len(e[2]) for e in self.entries[lo:hi])
+        del self.entries[lo:hi]
+
+    def forget(self, key):
+        """Forgets every packet with a key up to key and stops claiming them."""
+        n = bisect_left(self.entries, (key[0], key[1] + 1))
+        self.bytes -= sum(len(e[2]) for e in self.entries[:n])
+        del self.entries[:n]
+        self.floor = max(self.floor, key)
+
+    def count(self, since, to, limit):
+        lo = bisect_right(self.entries, (since, MAX_SEQ))
+        hi = bisect_left(self.entries, (to, ))
+        n = max(hi - lo, 0)
+        return min(n, limit) if limit > 0 else n
+
+    def page(self, since, to, after, n):
+        """Up to n packets of (since, to) below the after key, newest first,
+        as (timestamp, data, codec, seq) rows. Returns None if the cache can't
+        tell the page is complete."""
+        lo = bisect_right(self.entries, (since, MAX_SEQ))
+        hi = min(bisect_left(self.entries, (to, )), bisect_left(self.entries, after))
+        if hi - lo < n and not self.covers(since):
+            return None
+        return [(ts, data, RAW, seq) for ts, seq, data in reversed(self.entries[max(lo, hi - n):hi])]
+
+    def load(self, packets, floor):
+        """Replaces the content with (timestamp, seq, data) packets, oldest
+        first, which are all the stored packets above floor."""
+        self.entries = list(packets)
+        self.bytes = sum(len(e[2]) for e in self.entries)
+        self.floor = floor
@@ -0,0 +1,128 @@
+import threading, logging, time
+from collections import OrderedDict, deque
+
+log = logging.getLogger("btserver")
+
+
+def requestKey(request):
+    return (request.frm, request.to, request.limit, request.sinceLast)
+
+
+class Checkpoint:
+    """Acknowledged progress of an interrupted transfer: the request it
+    served, the continuation token after the last acknowledged frame and the
+    range of acknowledged timestamps, frm being the oldest."""
+    def __init__(self, key, token, frm, to):
+        self.key = key
+        self.token = token
+        self.frm = frm
+        self.to = to
+        self.touched = time.time()
+
+
+class Checkpoints:
+    """Checkpoints of interrupted transfers keyed by client address.
+
+    A client which reconnects with the same request and `resume` set picks up
+    after the last frame it acknowledged. At most `capacity` checkpoints are
+    kept, the least recently stored one is evicted to make room, and
+    checkpoints older than `ttl` seconds are dropped.
+    """
+    def __init__(self, capacity = 64, ttl = 600.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.checkpoints = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, address, checkpoint):
+        with self.lock:
+            self.expire()
+            self.checkpoints.pop(address, None)
+            while len(self.checkpoints) >= self.capacity:
+                self.checkpoints.popitem(last = False)
+            self.checkpoints[address] = checkpoint
+
+    def take(self, address, key):
+        """Removes and returns the checkpoint of a client for a request, or
+        None if there is none."""
+        with self.lock:
+            self.expire()
+            checkpoint = self.checkpoints.get(address)
+            if checkpoint is None or checkpoint.key != key:
+                return None
+            del self.checkpoints[address]
+            return checkpoint
+
+    def save(self, address, progress):
+        """Records the progress of an interrupted transfer. Returns the new
+        checkpoint, or None if the client acknowledged nothing new and the
+        checkpoint resumed, if any, still holds."""
+        checkpoint = progress.checkpoint()
+        if checkpoint is not None:
+            self.put(address, checkpoint)
+            log.info("Checkpoint of {} at {} [{}]".format(address, checkpoint.frm, checkpoint.token))
+        elif progress.resumed is not None:
+            self.put(address, progress.resumed)
+        return checkpoint
+
+    def remove(self, address):
+        with self.lock:
+            self.checkpoints.pop(address, None)
+
+    def expire(self):
+        deadline = time.time() - self.ttl
+        while self.checkpoints:
+            address, checkpoint = next(self.checkpoints.iteritems())
+            if checkpoint.touched > deadline:
+                break
+            del self.checkpoints[address]
+            log.info("Checkpoint of {} expired".format(address))
+
+    def __len__(self):
+        return len(self.checkpoints)
+
+
+class Progress:
+    """Frames of a transfer written to the client and how far the client
+    acknowledged them. Ack.received counts the packets of this transfer, so
+    checkpoints fall on frame boundaries. Without acks only the range of
+    sent timestamps is tracked."""
+    def __init__(self, key, acks = False, resumed = None):
+        self.key = key
+        self.acks = acks
+        self.resumed = resumed
+        self.frames = deque()
+        self.count = 0
+        self.acked = None
+        self.frm = 2 ** 63
+        self.to = resumed.to if resumed is not None else 0
+
+    def sent(self, frame):
+        if frame.count > 0:
+            self.count += frame.count
+            self.frm = min(self.frm, frame.frm)
+            self.to = max(self.to, frame.to)
+            if self.acks:
+                self.frames.append((self.count, frame.frm, frame.token))
+
+    def ack(self, ack):
+        while self.frames and self.frames[0][0] <= ack.received:
+            count, frm, token = self.frames[0]
+            if count == ack.received and frm != ack.timestamp:
+                log.warn("Acknowledged timestamp {} does not match sent {}".format(ack.timestamp, frm))
+                return
+            self.frames.popleft()
+            self.acked = (frm, token)
+        log.debug("Client acknowledged {} packets".format(ack.received))
+
+    def timerange(self):
+        """Timestamps of every packet sent, including those of the transfer
+        resumed."""
+        return (self.frm, self.to)
+
+    def checkpoint(self):
+        """Checkpoint after the last frame acknowledged by this transfer, or
+        None."""
+        if self.acked is None:
+            return None
+        return Checkpoint(self.key, self.acked[1], self.acked[0], self.to)
@@ -1,9 +1,12 @@
-import argparse, time, Pyro4, sys, os
+import argparse, time, Pyro4, sys, os, shutil
 from datetime import timedelta
 
 import config
 from eris import Eris
+from backend import Backend
 from storage import Storage
+from segments import SegmentStorage
+from logstore import LogStorage
 
 SLEEP_PERIOD = 0.25
 STATUS_RETRIES = 3
@@ -40,7 +43,7 @@ def stop(args):
         pass
     
 def status(args = None):
-    def printStatus(statusFile, pid = None, cpu = None, mem = None, uptime = None, du = None):
+    def printStatus(statusFile, pid = None, cpu = None, mem = None, uptime = None, du = None, count = None):
         status = (color("WORKING", "green")   if statusFile and pid else
                   color("NOT WORKING", "red") if not statusFile and pid is None else
                   color("UNKNOWN", "red"))
@@ -50,6 +53,7 @@ def status(args = None):
             print "    CPU:     {:.1f}%".format(cpu)
             print "    MEM:     {:.1f}%".format(mem)
             print "    Storage: {} KiB".format(du)
+            print "    Packets: {}".format(count)
             print "    Up-time: {}".format(str(timedelta(uptime.days, uptime.seconds, 0)))
             
     statusFile = False
@@ -59,8 +63,8 @@ def status(args = None):
     except:
         pass
     try:
-        (pid, cpu, mem, uptime, du) = Eris.getProxy().status()
-        printStatus(statusFile, pid, cpu, mem, uptime, du)
+        (pid, cpu, mem, uptime, du, count) = Eris.getProxy().status()
+        printStatus(statusFile, pid, cpu, mem, uptime, du, count)
     except Pyro4.errors.PyroError:
         printStatus(statusFile)
         
@@ -69,7 +73,8 @@ def put(args):
         data = open(args.file, "r").read() if args.file else sys.stdin.read()
         packets = [(args.timestamp, data)]
         proxy = Eris.getProxy()
-        proxy.put(packets)
+        if not proxy.put(packets):
+            print >> sys.stderr, "failed to store packet"
     except IOError as e:
         print >> sys.stderr, e
     except Pyro4.errors.PyroError:
@@ -100,11 +105,15 @@ def clean(args):
         Eris.getProxy().status()
         print >> sys.stderr, "eris must be stopped"
     except Pyro4.errors.PyroError:
-        try:
-            print "storage deleted"
-            os.remove(Storage.dbFile())
-        except:
-            pass
+        print "storage deleted"
+        for dbFile in (Storage.dbFile(), Backend.syncFile()):
+            for suffix in ("", "-wal", "-shm", "-journal"):
+                try:
+                    os.remove(dbFile + suffix)
+                except OSError:
+                    pass
+        shutil.rmtree(SegmentStorage.segmentDir(), ignore_errors = True)
+        shutil.rmtree(LogStorage.logDir(), ignore_errors = True)
 
 
 def color(text, clr):
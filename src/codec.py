@@ -0,0 +1,62 @@
+import zlib
+
+import wire
+
+RAW = 0
+ZLIB = 1
+WIRE = 2
+
+NAMES = {
+    "raw": RAW,
+    "zlib": ZLIB,
+    "wire": WIRE,
+}
+
+
+class Codec:
+    """Compression applied to packet payloads before they are stored.
+
+    Every stored row records the codec it was encoded with, so the codec can be
+    changed in eris.yaml at any time and old rows stay readable. Payloads which
+    are too small or do not shrink are stored raw. The wire codec stores the
+    payload already encoded as a protobuf Packet.data field, ready to be
+    copied into Response frames.
+    """
+    def __init__(self, name = "raw", level = 6, minSize = 64):
+        self.codec = NAMES[name]
+        self.level = level
+        self.minSize = minSize
+
+    def encode(self, data):
+        if self.codec == WIRE:
+            return WIRE, wire.dataField(data)
+        if self.codec == ZLIB and len(data) >= self.minSize:
+            encoded = zlib.compress(data, self.level)
+            if len(encoded) < len(data):
+                return ZLIB, encoded
+        return RAW, data
+
+    @staticmethod
+    def decode(codec, data):
+        if codec == ZLIB:
+            return zlib.decompress(data)
+        if codec == WIRE:
+            return str(wire.payload(data))
+        return str(data)
+
+    @staticmethod
+    def field(codec, data):
+        """Payload as an encoded Packet.data field: a tuple of segments which
+        reference the stored buffer whenever the payload isn't compressed."""
+        if codec == WIRE:
+            return (data, )
+        if codec == ZLIB:
+            data = zlib.decompress(data)
+        return (wire.dataHeader(data), data)
+
+
+def level(s):
+    l = int(s)
+    if l not in range(1, 10):
+        raise ValueError("Compression level should be in range [1, 9]")
+    return l
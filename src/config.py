@@ -117,6 +117,12 @@ def positiveInt(s):
         raise ValueError("Expected positive integer")
     return i
 
+def nonNegativeInt(s):
+    i = int(s)
+    if i < 0:
+        raise ValueError("Expected non-negative integer")
+    return i
+
 def positiveFloat(s):
     f = float(s)
     if not f > 0.0:
@@ -135,6 +141,14 @@ def positivePercent(s):
         raise ValueError("Expected a number in range (0.0, 100.0]")
     return f
 
+def choice(*options):
+    def cast(s):
+        c = str(s).strip().lower()
+        if c not in options:
+            raise ValueError("Expected one of: " + ", ".join(options))
+        return c
+    return cast
+
 def channel(s):
     c = int(s)
     if c not in range(1, 31):
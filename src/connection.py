@@ -1,8 +1,13 @@
-import threading, logging
-import bt_pb2
+import threading, logging, time
+import bt_pb2, wire
 from config import genConnId
+from framing import FrameReader, FrameWriter, FrameError
+from prefetch import Prefetcher, pushFrames
+from checkpoints import Progress, requestKey
+from subscriptions import Subscription
 
 log = logging.getLogger("btserver")
+MAX_REQUEST = 2 ** 16
 
 
 connections = {}
@@ -16,17 +21,82 @@ class InvalidRequest(Exception): pass
 class InternalError(Exception): pass
 
 
+def parseRequest(serialized):
+    request = bt_pb2.Request()
+    try:
+        request.ParseFromString(serialized)
+    except:
+        raise InvalidRequest("Couldn't parse request")
+    return request
+
+def parseAck(serialized):
+    ack = bt_pb2.Ack()
+    try:
+        ack.ParseFromString(serialized)
+    except:
+        raise InvalidRequest("Couldn't parse acknowledgement")
+    return ack
+
+def since(storage, address, request):
+    """Start of the range a Request asks for: with sinceLast, no older than
+    the last sync of the client."""
+    if request.sinceLast:
+        last = storage.lastSync(address)
+        if last is not None:
+            return max(request.frm, last)
+    return request.frm
+
+def covered(request, resumed, packetCount):
+    """Whether a transfer of packetCount packets covers the whole range of a
+    Request. Transfers go newest first, so one cut short by the limit leaves
+    older packets unsent and must not move the client's sync mark. A resumed
+    transfer only knows what was left of its query, so a limited one is
+    never taken as covering the range."""
+    if request.limit <= 0:
+        return True
+    return resumed is None and packetCount < request.limit
+
+def errorFrame(code, desc = ""):
+    response = bt_pb2.Response()
+    response.error.code = code
+    if desc:
+        response.error.description = desc
+    serialized = response.SerializeToString()
+    return wire.varint(len(serialized)) + serialized
+
+def reject(sock, desc):
+    """Turns away a client which can't be served, with an error frame."""
+    log.warn("Rejecting connection: " + desc)
+    try:
+        sock.sendall(errorFrame(bt_pb2.Error.INTERNAL_ERROR, desc))
+    except:
+        log.debug("Couldn't send error message", exc_info = 1)
+    try:
+        sock.close()
+    except:
+        pass
+
+
 class Connection(threading.Thread):
-    def __init__(self, sock, btserver):
+    def __init__(self, sock, btserver, address = None):
         threading.Thread.__init__(self)
         
         self.connId = connectionId.next()
         connections[self.connId] = self
         
         self.sock = sock
+        self.address = address
+        self.reader = FrameReader(sock)
+        self.writer = FrameWriter(sock)
         self.storage = btserver.storage
         self.delSent = btserver.delSent
-        self.batch = btserver.batch
+        self.batchSizer = btserver.batchSizer
+        self.deflater = btserver.deflater
+        self.frameCache = btserver.frameCache
+        self.prefetch = btserver.prefetch
+        self.checkpoints = btserver.checkpoints
+        self.subscribeBuffer = btserver.subscribeBuffer
+        self.stats = {}
         self.running = True
         
     def run(self):
@@ -37,7 +107,7 @@ class Connection(threading.Thread):
             log.exception("Internal Error during bluetooth comms")
             self.sendError(bt_pb2.Error.INTERNAL_ERROR, e.message)
         
-        except InvalidRequest as e:
+        except (InvalidRequest, FrameError) as e:
             log.exception("Invalid bluetooth request")
             self.sendError(bt_pb2.Error.INVALID_REQUEST, e.message)
             
@@ -50,112 +120,170 @@ class Connection(threading.Thread):
             self.kill()
     
     def processRequest(self):
-        timerange = (2 ** 63, 0)
-        def updateTimerange(frm, to):
-            f = min(timerange[0], frm)
-            t = max(timerange[1], to)
-            return (f, t)
-        
         dbConnId = 0
+        progress = None
+        completed = False
+        subscription = None
         try:
             n = self.readLen()
             log.debug("Request is {} bytes long".format(n))
-            serialized = self.sock.recv(n) if n > 0 else ""
-            request = bt_pb2.Request()
-            try:
-                request.ParseFromString(serialized)
-            except:
-                raise InvalidRequest("Couldn't parse request")
+            if n > MAX_REQUEST:
+                raise InvalidRequest("Request too long")
+            serialized = self.reader.read(n)
+            request = parseRequest(serialized)
             
-            dbConnId, packetCount = self.storage.get(request.frm, request.to, request.limit)
+            key = requestKey(request)
+            resumed = self.checkpoints.take(self.address, key) if request.resume else None
+            frm = since(self.storage, self.address, request)
+            if request.subscribe:
+                subscription = Subscription(frm, request.to, self.subscribeBuffer)
+            if resumed is not None:
+                dbConnId, packetCount = self.storage.resume(resumed.token, subscription)
+            else:
+                dbConnId, packetCount = self.storage.get(frm, request.to, request.limit, subscription)
+            progress = Progress(key, request.ackEvery > 0, resumed)
             if dbConnId is None:
                 raise InternalError("Database error")
             
-            batch = request.batch if request.batch > 0 else self.batch
-            full = request.full
-            initial = True
-            while self.running:
-                response = bt_pb2.Response()
-                packets = self.storage.fetch(dbConnId, n = batch)
-                if len(packets) > 0:
-                    timerange = updateTimerange(packets[-1][0], packets[0][0])
-                    if not full:
-                        response.frm = packets[-1][0]
-                        response.to = packets[0][0]
-                    if initial:
-                        response.noPackets = packetCount
-                        initial = False
-                        
-                for (t, data) in packets:
-                    packet = response.packets.add()
-                    if full:
-                        packet.timestamp = t
-                    packet.data = data
+            sizer = self.batchSizer(request.batch)
+            deflater = self.deflater(request.codecs)
+            prefetcher = Prefetcher(self.storage, dbConnId, sizer, request.full, packetCount, self.prefetch,
+                                    deflater, self.frameCache)
+            prefetcher.begin()
+            try:
+                while self.running:
+                    frame = prefetcher.next(timeout = 0.5)
+                    if frame is None:
+                        continue
                     
-                serialized = response.SerializeToString()
-                self.writeLen(len(serialized))
-                log.debug("Response is {} bytes long".format(len(serialized)))
-                self.sock.send(serialized)
-                if len(packets) == 0:
-                    break
-            
-            n = self.readLen()
-            if n == packetCount:
-                self.writeLen(1)
-                log.info("{} packets sent".format(n))
-                if self.delSent and packetCount > 0:
-                    self.storage.delete(*timerange)
-            else:
-                log.warn("Client did not respond with correct number of packets. Expected: {}, actual: {}".
-                         format(packetCount, n))
-                self.writeLen(0)
+                    self.sendFrame(frame, sizer, progress, request.ackEvery)
+                    if frame.count == 0:
+                        break
+            finally:
+                prefetcher.stop()
+                self.stats = sizer.stats()
+                log.info("Transfer: " + sizer.summary())
+                if deflater is not None:
+                    log.info("Transfer: " + deflater.summary())
             
+            sync = covered(request, resumed, packetCount)
+            completed = self.confirm(progress, packetCount, request.ackEvery, sync)
+            if subscription is not None:
+                self.push(subscription, sizer, request, sync)
             
             log.info("Finishing communications")
             self.shutdownSock()
         finally:
             self.storage.closeConn(dbConnId)
+            if subscription is not None:
+                self.storage.unsubscribe(subscription)
+            if progress is not None and not completed:
+                self.interrupted(progress)
 
-    def readLen(self):
-        ret = 0
-        i = 0
-        byte = 0
+    def sendFrame(self, frame, sizer, progress, ackEvery):
+        start = time.time()
+        self.writer.writeChunks(frame.chunks)
+        sizer.sent(frame, time.time() - start)
+        progress.sent(frame)
+        if ackEvery > 0 and frame.count > 0:
+            self.readAcks(progress)
+        log.debug("Response is {} bytes long".format(frame.size))
+
+    def confirm(self, progress, packetCount, ackEvery, sync = True):
+        """Reads the number of packets the client received and answers it.
+        With sync, a match moves the client's sync mark. Returns whether it
+        matched packetCount."""
+        n = self.readLastAck(progress) if ackEvery > 0 else self.readLen()
+        if n != packetCount:
+            log.warn("Client did not respond with correct number of packets. Expected: {}, actual: {}".
+                     format(packetCount, n))
+            self.writeLen(0)
+            return False
+        self.checkpoints.remove(self.address)
+        if sync and packetCount > 0:
+            self.storage.synced(self.address, progress.to)
+        self.writeLen(1)
+        log.info("{} packets sent".format(n))
+        if self.delSent and packetCount > 0:
+            self.storage.delete(*progress.timerange())
+        return True
+
+    def push(self, subscription, sizer, request, sync):
+        """Serves a subscription until the client hangs up: packets stored
+        after the first transfer are sent as soon as they are committed, each
+        batch as a transfer of its own, with a zlib stream of its own when
+        deflated, and confirmed like the first one. Pushed
+        transfers are not checkpointed, an interrupted client catches up with
+        sinceLast."""
+        log.info("Client {} subscribed".format(self.address))
+        while self.running:
+            try:
+                if self.reader.poll(MAX_REQUEST) is not None:
+                    raise InvalidRequest("Unexpected message from subscriber")
+            except (FrameError, IOError):
+                log.info("Subscriber {} disconnected".format(self.address))
+                return
+            if not subscription.wait(0.5):
+                continue
+            packets = subscription.take()
+            if packets is None:
+                raise InternalError("Subscriber fell too far behind")
+            if not packets:
+                continue
+            progress = Progress(requestKey(request))
+            for frame in pushFrames(packets, sizer, request.full, self.deflater(request.codecs)):
+                self.sendFrame(frame, sizer, progress, request.ackEvery)
+            self.confirm(progress, len(packets), request.ackEvery, sync)
+
+    def interrupted(self, progress):
+        """Checkpoints a transfer the client didn't complete. With delete_sent
+        the packets it acknowledged are deleted, all but those sharing the
+        timestamp of the checkpoint, which may still be due."""
+        checkpoint = self.checkpoints.save(self.address, progress)
+        if checkpoint is not None and self.delSent and checkpoint.frm < checkpoint.to:
+            self.storage.delete(checkpoint.frm + 1, checkpoint.to)
+
+    def readAcks(self, progress):
+        """Takes the acknowledgements the client has sent so far."""
+        while True:
+            serialized = self.reader.poll(MAX_REQUEST)
+            if serialized is None:
+                return
+            progress.ack(parseAck(serialized))
+
+    def readLastAck(self, progress):
+        """Waits for the acknowledgement ending the transfer and returns the
+        number of packets received."""
         while True:
             try:
-                byte = ord(self.sock.recv(1)[0])
+                serialized = self.reader.readFrame(MAX_REQUEST)
+            except FrameError as e:
+                raise InvalidRequest(e.message)
             except:
-                raise InvalidRequest("Request length unavailable")
-            ret += (byte & 0x7F) << (i * 7)
-            i += 1
-            if byte & 0x80 == 0:
-                break
-            if i > 5:
-                raise InvalidRequest("Request too long")
-        return ret
+                raise InvalidRequest("Acknowledgement unavailable")
+            ack = parseAck(serialized)
+            progress.ack(ack)
+            if ack.last:
+                return ack.received
+
+    def readLen(self):
+        try:
+            return self.reader.readVarint()
+        except FrameError as e:
+            raise InvalidRequest(e.message)
+        except:
+            raise InvalidRequest("Request length unavailable")
         
     def writeLen(self, n):
-        if n > 2 ** 31 - 1:
-            raise InvalidRequest("Response too long")
-        i = 0
-        while True:
-            byte = (n >> (7 * i)) & 0x7F
-            msb = 0x80 if (n >> (7 * (i + 1))) > 0 else 0x0
-            i += 1
-            byte |= msb
-            self.sock.send(chr(byte))
-            if msb == 0:
-                break
+        try:
+            self.writer.writeVarint(n)
+        except FrameError as e:
+            raise InvalidRequest(e.message)
 
     def sendError(self, code, desc = ""):
         try:
             log.debug("Sending error message")
-            response = bt_pb2.Response()
-            response.error.code = code
-            if desc:
-                response.error.description = desc
-            serialized = response.SerializeToString()
-            self.writeLen(len(serialized))
-            self.sock.send(serialized)
+            self.sock.sendall(errorFrame(code, desc))
         except:
             log.exception("Couldn't send error message")
         finally:
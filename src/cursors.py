@@ -0,0 +1,101 @@
+import threading, logging, time
+from collections import OrderedDict
+
+from config import genConnId
+
+log = logging.getLogger("storage")
+
+
+class Query:
+    """Position of a paginated range query.
+
+    A query is pure state: the range, how many packets may still be returned
+    and the (timestamp, seq) key of the last packet returned, or before the
+    first page a key just above the newest packet counted. Each page reads
+    packets strictly below that key, newest first, so no database connection
+    or snapshot is held between pages. The state round-trips through a token
+    "since:to:remaining:lastTs:lastSeq", which lets a transfer be resumed
+    later, on any connection.
+    """
+    def __init__(self, since, to, remaining, lastTs = None, lastSeq = 0):
+        self.since = long(since)
+        self.to = long(to)
+        self.remaining = remaining
+        self.lastTs = self.to if lastTs is None else long(lastTs)
+        self.lastSeq = long(lastSeq)
+        self.touched = time.time()
+
+    def after(self):
+        return (self.lastTs, self.lastSeq)
+
+    def advance(self, key, n):
+        self.lastTs, self.lastSeq = key
+        self.remaining -= n
+
+    def done(self):
+        return self.remaining <= 0
+
+    def token(self):
+        return "{}:{}:{}:{}:{}".format(self.since, self.to, self.remaining, self.lastTs, self.lastSeq)
+
+    @staticmethod
+    def parse(token):
+        since, to, remaining, lastTs, lastSeq = str(token).split(":")
+        remaining = int(remaining)
+        if remaining < 0:
+            raise ValueError("Invalid continuation token [{}]".format(token))
+        return Query(since, to, remaining, lastTs, lastSeq)
+
+
+class Cursors:
+    """Registry of open queries keyed by connection id.
+
+    At most `capacity` queries are kept; the least recently used one is
+    evicted to make room, and queries idle for longer than `ttl` seconds are
+    dropped whenever the registry is touched.
+    """
+    def __init__(self, capacity = 64, ttl = 300.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.queries = OrderedDict()
+        self.connectionId = genConnId()
+        self.lock = threading.Lock()
+
+    def add(self, query):
+        with self.lock:
+            self.expire()
+            while len(self.queries) >= self.capacity:
+                connId, _ = self.queries.popitem(last = False)
+                log.warn("Too many open cursors, evicting cursor {}".format(connId))
+            connId = self.connectionId.next()
+            self.queries[connId] = query
+            return connId
+
+    def get(self, connId):
+        with self.lock:
+            self.expire()
+            query = self.queries.pop(connId, None)
+            if query is not None:
+                query.touched = time.time()
+                self.queries[connId] = query
+            return query
+
+    def remove(self, connId):
+        with self.lock:
+            return self.queries.pop(connId, None)
+
+    def clear(self):
+        with self.lock:
+            self.queries.clear()
+
+    def expire(self):
+        deadline = time.time() - self.ttl
+        while self.queries:
+            connId, query = next(self.queries.iteritems())
+            if query.touched > deadline:
+                break
+            del self.queries[connId]
+            log.info("Cursor {} expired".format(connId))
+
+    def __len__(self):
+        return len(self.queries)
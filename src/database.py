@@ -0,0 +1,87 @@
+import sqlite3, logging, threading
+from Queue import Queue, Empty
+
+log = logging.getLogger("storage")
+
+
+class Database:
+    """Long-lived SQLite connections to a single database file.
+
+    There is exactly one writer connection (callers serialize access to it)
+    and a bounded pool of reader connections which are created lazily and
+    handed out with acquireReader/releaseReader. In WAL mode readers work on
+    their own snapshot and never block the writer.
+    """
+    def __init__(self, dbFile, pragmas = (), readers = 4, timeout = 10.0):
+        self.dbFile = dbFile
+        self.pragmas = list(pragmas)
+        self.timeout = timeout
+        self.maxReaders = readers
+        self.readers = 0
+        self.idle = Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.writer = self.connect()
+
+    def connect(self):
+        conn = sqlite3.connect(self.dbFile, timeout = self.timeout, check_same_thread = False)
+        for name, value in self.pragmas:
+            conn.execute("PRAGMA {} = {}".format(name, value))
+        return conn
+
+    def acquireReader(self, timeout = None):
+        if self.closed:
+            return None
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+
+        with self.lock:
+            create = self.readers < self.maxReaders
+            if create:
+                self.readers += 1
+        if create:
+            try:
+                return self.connect()
+            except:
+                with self.lock:
+                    self.readers -= 1
+                raise
+
+        try:
+            return self.idle.get(timeout = self.timeout if timeout is None else timeout)
+        except Empty:
+            return None
+
+    def releaseReader(self, conn):
+        if self.closed:
+            self.discardReader(conn)
+            return
+        try:
+            conn.rollback()
+        except:
+            log.warn("Discarding broken reader connection", exc_info = 1)
+            self.discardReader(conn)
+            return
+        self.idle.put(conn)
+
+    def discardReader(self, conn):
+        with self.lock:
+            self.readers -= 1
+        try:
+            conn.close()
+        except:
+            pass
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self.discardReader(self.idle.get_nowait())
+            except Empty:
+                break
+        try:
+            self.writer.close()
+        except:
+            log.warn("Error closing writer connection", exc_info = 1)
@@ -1,8 +1,7 @@
 import sys, os, Pyro4, psutil, logging
 from datetime import datetime
  
-import cli, config
-from storage import Storage
+import cli, config, backend
 from btserver import BtServer
 from retriever import Retriever
 
@@ -30,7 +29,7 @@ class Eris:
             return
         
         self.startTime = datetime.now()
-        self.storage = Storage()
+        self.storage = backend.create()
         self.btserver = BtServer(self.storage)
         self.retriever = Retriever(self.storage)
         self.btserver.start()
@@ -52,6 +51,7 @@ class Eris:
             self.retriever.kill()
             self.retriever.join(1.0)
             self.btserver.join(1.0)
+            self.storage.close()
 
             with open(config.statusFile, "w"):
                 pass
@@ -66,10 +66,11 @@ class Eris:
         mem = proc.get_memory_percent()
         uptime = datetime.now() - self.startTime
         du = self.storage.size()
-        return (pid, cpu, mem, uptime, du)
+        count = self.storage.rowcount()
+        return (pid, cpu, mem, uptime, du, count)
         
     def put(self, packets):
-        self.storage.put(packets)
+        return self.storage.put(packets, sync = True)
         
     def get(self, since = 0, to = 0, limit = 0):
         connId, _ = self.storage.get(since, to, limit)
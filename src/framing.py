@@ -0,0 +1,125 @@
+import select
+
+import wire
+
+RECV_BYTES = 4096
+COALESCE_BYTES = 64 * 1024
+BUFFER_BYTES = 16 * 1024
+MAX_VARINT = 5
+MAX_FRAME = 2 ** 31 - 1
+
+
+class FrameError(Exception): pass
+
+
+def parseVarint(buf, offset = 0):
+    """Decodes a varint at offset of buf. Returns (value, end offset), or
+    None if buf ends before the varint does."""
+    ret = 0
+    for i in range(MAX_VARINT):
+        if offset + i >= len(buf):
+            return None
+        byte = ord(buf[offset + i])
+        ret += (byte & 0x7F) << (i * 7)
+        if byte & 0x80 == 0:
+            return ret, offset + i + 1
+    raise FrameError("Frame length too long")
+
+
+def coalesce(segments):
+    """Length prefixed frame of str and buffer segments as a list of chunks
+    to send. A frame of up to COALESCE_BYTES is a single chunk; in larger
+    frames segments of BUFFER_BYTES or more stay separate chunks so their
+    buffers aren't copied, and the small segments between them are joined."""
+    size = sum(len(s) for s in segments)
+    if size > MAX_FRAME:
+        raise FrameError("Response too long")
+    prefix = wire.varint(size)
+    if size + len(prefix) <= COALESCE_BYTES:
+        return ["".join([prefix] + [str(s) for s in segments])]
+    chunks = []
+    pending = [prefix]
+    for s in segments:
+        if len(s) >= BUFFER_BYTES:
+            if pending:
+                chunks.append("".join(pending))
+                pending = []
+            chunks.append(s)
+        else:
+            pending.append(str(s))
+    if pending:
+        chunks.append("".join(pending))
+    return chunks
+
+
+class FrameReader:
+    """Reads varint length prefixed frames from a blocking socket, receiving
+    in blocks of RECV_BYTES instead of a byte at a time."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ""
+
+    def fill(self):
+        data = self.sock.recv(RECV_BYTES)
+        if not data:
+            raise FrameError("Connection closed by peer")
+        self.buf += data
+
+    def readVarint(self):
+        while True:
+            parsed = parseVarint(self.buf)
+            if parsed is not None:
+                value, end = parsed
+                self.buf = self.buf[end:]
+                return value
+            self.fill()
+
+    def read(self, n):
+        while len(self.buf) < n:
+            self.fill()
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+    def readFrame(self, maxSize = MAX_FRAME):
+        n = self.readVarint()
+        if n > maxSize:
+            raise FrameError("Frame too long")
+        return self.read(n)
+
+    def poll(self, maxSize = MAX_FRAME):
+        """Next frame if it has fully arrived, otherwise None. Doesn't block."""
+        while True:
+            parsed = parseVarint(self.buf)
+            if parsed is not None:
+                n, start = parsed
+                if n > maxSize:
+                    raise FrameError("Frame too long")
+                if len(self.buf) >= start + n:
+                    frame, self.buf = self.buf[start:start + n], self.buf[start + n:]
+                    return frame
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                return None
+            self.fill()
+
+
+class FrameWriter:
+    """Writes length prefixed frames, prefix and payload coalesced into as
+    few sendall calls as the frame allows."""
+    def __init__(self, sock):
+        self.sock = sock
+
+    def writeFrame(self, segments):
+        """Sends a frame given as str and buffer segments. Returns its size."""
+        self.writeChunks(coalesce(segments))
+        return sum(len(s) for s in segments)
+
+    def writeChunks(self, chunks):
+        """Sends a frame already split into chunks by coalesce."""
+        for chunk in chunks:
+            self.sock.sendall(chunk)
+
+    def writeVarint(self, n):
+        if n > MAX_FRAME:
+            raise FrameError("Response too long")
+        self.sock.sendall(wire.varint(n))
@@ -0,0 +1,110 @@
+import threading, logging, time
+from Queue import Queue, Empty
+
+log = logging.getLogger("storage")
+
+
+class Ack:
+    """Durability acknowledgement for a batch of packets handed to Ingest."""
+    def __init__(self, packets):
+        self.packets = packets
+        self.size = sum(len(d) for _, d in packets)
+        self.event = threading.Event()
+        self.ok = False
+
+    def done(self, ok):
+        self.ok = ok
+        self.event.set()
+
+    def wait(self, timeout = None):
+        self.event.wait(timeout)
+        return self.ok
+
+
+class Ingest(threading.Thread):
+    """Single writer thread which drains queued packets in group commits.
+
+    Every flush hands all packets gathered so far to the flush callback at
+    once. A flush is started as soon as any of the limits (packet count,
+    payload bytes, or the time window since the first queued packet) is
+    reached, or the queue runs dry and the window has elapsed. Packets put
+    after kill() are not stored, their Ack fails at once.
+    """
+    def __init__(self, flush, maxPackets = 256, maxBytes = 1024 * 1024, window = 0.05):
+        threading.Thread.__init__(self, name = "ingest")
+        self.daemon = True
+        self.flush = flush
+        self.maxPackets = maxPackets
+        self.maxBytes = maxBytes
+        self.window = window
+        self.queue = Queue()
+        self.killed = False
+        self.lock = threading.Lock()
+
+    def put(self, packets):
+        ack = Ack(packets)
+        with self.lock:
+            if not self.killed:
+                self.queue.put(ack)
+                return ack
+        log.warn("Ingest stopped, dropping {} packets".format(len(packets)))
+        ack.done(False)
+        return ack
+
+    def run(self):
+        running = True
+        while running:
+            ack = self.queue.get()
+            if ack is None:
+                break
+            acks = [ack]
+            count = len(ack.packets)
+            size = ack.size
+            deadline = time.time() + self.window
+            while count < self.maxPackets and size < self.maxBytes:
+                try:
+                    ack = self.queue.get_nowait()
+                except Empty:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        ack = self.queue.get(timeout = remaining)
+                    except Empty:
+                        break
+                if ack is None:
+                    running = False
+                    break
+                acks.append(ack)
+                count += len(ack.packets)
+                size += ack.size
+            self.commit(acks)
+
+        self.drain()
+
+    def commit(self, acks):
+        ok = False
+        try:
+            ok = self.flush([p for ack in acks for p in ack.packets])
+        except:
+            log.error("Failed to flush ingest queue", exc_info = 1)
+        finally:
+            for ack in acks:
+                ack.done(ok)
+
+    def drain(self):
+        acks = []
+        while True:
+            try:
+                ack = self.queue.get_nowait()
+            except Empty:
+                break
+            if ack is not None:
+                acks.append(ack)
+        if acks:
+            self.commit(acks)
+
+    def kill(self):
+        with self.lock:
+            self.killed = True
+            self.queue.put(None)
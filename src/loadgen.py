@@ -0,0 +1,200 @@
+import argparse, socket, sys, threading, time, zlib
+
+import bt_pb2, wire
+from framing import FrameReader
+
+# Load generator for the bluetooth protocol: simulated handhelds run the
+# Request/Response/count exchange against a server listening on TCP or a
+# Unix domain socket (or RFCOMM, with pybluez), at increasing concurrency.
+
+
+class ExchangeError(Exception): pass
+
+
+def connector(args):
+    """Function opening a connection to the server the arguments point at."""
+    if args.unix:
+        def connect():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(args.timeout)
+            sock.connect(args.unix)
+            return sock
+    elif args.rfcomm:
+        import bluetooth as bt
+        address, _, channel = args.rfcomm.partition("/")
+        def connect():
+            sock = bt.BluetoothSocket(bt.RFCOMM)
+            sock.settimeout(args.timeout)
+            sock.connect((address, int(channel or 2)))
+            return sock
+    else:
+        host, _, port = args.tcp.rpartition(":")
+        def connect():
+            sock = socket.create_connection((host or "127.0.0.1", int(port)), args.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+    return connect
+
+
+def request(args):
+    req = bt_pb2.Request()
+    req.frm = args.since
+    req.to = args.to
+    req.limit = args.limit
+    req.batch = args.batch
+    req.full = not args.short
+    req.ackEvery = args.ack_every
+    req.sinceLast = args.since_last
+    if args.deflate:
+        req.codecs.append(bt_pb2.Request.DEFLATE)
+    return req
+
+
+def send(sock, message):
+    serialized = message.SerializeToString()
+    sock.sendall(wire.varint(len(serialized)) + serialized)
+
+
+def exchange(sock, req):
+    """Runs one transfer as a handheld would. Returns the number of packets
+    and bytes received."""
+    reader = FrameReader(sock)
+    send(sock, req)
+    inflater = zlib.decompressobj()
+    received = acked = size = oldest = 0
+    while True:
+        frame = reader.readFrame()
+        size += len(frame) + len(wire.varint(len(frame)))
+        response = bt_pb2.Response()
+        response.ParseFromString(frame)
+        if response.HasField("error"):
+            raise ExchangeError(response.error.description or "error {}".format(response.error.code))
+        if response.HasField("compressed"):
+            compressed = response.compressed
+            response = bt_pb2.Response()
+            response.ParseFromString(inflater.decompress(compressed))
+        if len(response.packets) == 0:
+            break
+        received += len(response.packets)
+        oldest = response.packets[-1].timestamp if req.full else response.frm
+        if req.ackEvery > 0 and received - acked >= req.ackEvery:
+            send(sock, bt_pb2.Ack(timestamp = oldest, received = received))
+            acked = received
+    if req.ackEvery > 0:
+        send(sock, bt_pb2.Ack(timestamp = oldest, received = received, last = True))
+    else:
+        sock.sendall(wire.varint(received))
+    if reader.readVarint() != 1:
+        raise ExchangeError("Packet count not confirmed")
+    return received, size
+
+
+class Level:
+    """Outcome of running clients at one concurrency for a while."""
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.latencies = []
+        self.packets = 0
+        self.bytes = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, latency, packets, size):
+        with self.lock:
+            self.latencies.append(latency)
+            self.packets += packets
+            self.bytes += size
+
+    def fail(self):
+        with self.lock:
+            self.errors += 1
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))] * 1000
+
+    def row(self):
+        elapsed = self.elapsed or 1.0
+        return ("{:>11} {:>9} {:>7} {:>9.1f} {:>11.1f} {:>11.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+            self.concurrency, len(self.latencies), self.errors, len(self.latencies) / elapsed,
+            self.bytes / elapsed / 1024, self.packets / elapsed,
+            self.percentile(50), self.percentile(90), self.percentile(99), self.percentile(100)))
+
+HEADER = "{:>11} {:>9} {:>7} {:>9} {:>11} {:>11} {:>8} {:>8} {:>8} {:>8}".format(
+    "concurrency", "requests", "errors", "req/s", "KiB/s", "packets/s", "p50 ms", "p90 ms", "p99 ms", "max ms")
+
+
+def run(connect, req, concurrency, duration, verbose = False):
+    level = Level(concurrency)
+    deadline = time.time() + duration
+    def client():
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                sock = connect()
+                try:
+                    packets, size = exchange(sock, req)
+                finally:
+                    sock.close()
+            except Exception as e:
+                level.fail()
+                if verbose:
+                    print >> sys.stderr, "request failed: {}".format(e)
+                time.sleep(0.01)
+                continue
+            level.add(time.time() - start, packets, size)
+    threads = [threading.Thread(target = client) for _ in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    level.elapsed = time.time() - start
+    return level
+
+
+def main():
+    def positiveInt(s):
+        i = int(s)
+        if i < 1:
+            raise argparse.ArgumentTypeError("expected positive integer")
+        return i
+
+    def levels(s):
+        return [positiveInt(c) for c in s.split(",")]
+
+    parser = argparse.ArgumentParser(prog = "loadgen",
+                                     description = "Drives an eris server with simulated handhelds and reports "
+                                     + "throughput and latency at each concurrency level")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--tcp", default = "127.0.0.1:7018", help = "host:port [default = 127.0.0.1:7018]")
+    target.add_argument("--unix", help = "Unix domain socket path")
+    target.add_argument("--rfcomm", help = "bdaddr[/channel] (needs pybluez)")
+    parser.add_argument("-c", "--concurrency", type = levels, default = [1, 4, 16],
+                        help = "Comma separated concurrency levels [default = 1,4,16]")
+    parser.add_argument("-d", "--duration", type = float, default = 10.0,
+                        help = "Seconds to run each level for [default = 10]")
+    parser.add_argument("-s", "--since", type = long, default = 0, help = "Request.frm")
+    parser.add_argument("-t", "--to", type = long, default = 0, help = "Request.to")
+    parser.add_argument("-l", "--limit", type = int, default = 0, help = "Request.limit")
+    parser.add_argument("-b", "--batch", type = int, default = 0, help = "Request.batch")
+    parser.add_argument("--short", action = "store_true", help = "Request packets without timestamps")
+    parser.add_argument("--ack-every", type = int, default = 0, help = "Request.ackEvery")
+    parser.add_argument("--deflate", action = "store_true", help = "Advertise deflate compression")
+    parser.add_argument("--since-last", action = "store_true", help = "Request.sinceLast")
+    parser.add_argument("--timeout", type = float, default = 10.0, help = "Socket timeout [default = 10]")
+    parser.add_argument("-v", "--verbose", action = "store_true", help = "Print failed requests")
+    args = parser.parse_args()
+
+    connect = connector(args)
+    req = request(args)
+    print HEADER
+    for concurrency in args.concurrency:
+        print run(connect, req, concurrency, args.duration, args.verbose).row()
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
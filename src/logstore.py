@@ -0,0 +1,372 @@
+import os, re, mmap, struct, zlib, logging
+from bisect import bisect_right
+
+import config
+from backend import Backend
+from cache import MAX_SEQ
+
+log = logging.getLogger("storage")
+
+HEADER = struct.Struct(">qBII")
+SEGMENT_FILE = re.compile(r"^(\d+)\.log$")
+TOMBSTONES = "tombstones"
+
+
+class Segment:
+    """One append-only log file.
+
+    Records are a header (timestamp, codec, payload length, payload crc32)
+    followed by the payload. While timestamps are appended in order the
+    segment keeps a sparse index of every n-th record, so a range read can
+    start close to its first record instead of at the beginning of the file.
+    Reads go through a read-only memory map which is extended as the file grows.
+    rows, bytes, minTs and maxTs describe live records only; `appended` and
+    `newestTs` describe the file, tombstoned records included.
+    """
+    def __init__(self, number, path, interval):
+        self.number = number
+        self.path = path
+        self.interval = interval
+        self.size = 0
+        self.appended = 0
+        self.newestTs = None
+        self.rows = 0
+        self.bytes = 0
+        self.minTs = None
+        self.maxTs = None
+        self.ordered = True
+        self.index = []
+        self.mm = None
+
+    def scan(self):
+        """Rebuilds statistics and the sparse index from the file, truncating
+        a torn record left behind by an interrupted write."""
+        size = os.path.getsize(self.path)
+        with open(self.path, "rb") as f:
+            offset = 0
+            while offset + HEADER.size <= size:
+                f.seek(offset)
+                ts, _, length, crc = HEADER.unpack(f.read(HEADER.size))
+                end = offset + HEADER.size + length
+                if end > size or zlib.crc32(f.read(length)) & 0xffffffff != crc:
+                    break
+                self.add(ts, offset, length)
+                offset = end
+        if offset < size:
+            log.warn("Truncating {} bytes of incomplete records in {}".format(size - offset, self.path))
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+        self.size = offset
+
+    def add(self, ts, offset, length):
+        if self.newestTs is not None and ts < self.newestTs:
+            self.ordered = False
+        if self.appended % self.interval == 0:
+            self.index.append((ts, offset))
+        self.appended += 1
+        self.newestTs = ts if self.newestTs is None else max(self.newestTs, ts)
+        self.rows += 1
+        self.bytes += length
+        self.minTs = ts if self.minTs is None else min(self.minTs, ts)
+        self.maxTs = ts if self.maxTs is None else max(self.maxTs, ts)
+
+    def append(self, f, packets, fsync = False):
+        """Appends (timestamp, codec, data) records and returns their offsets."""
+        chunks = []
+        offsets = []
+        offset = self.size
+        for ts, c, data in packets:
+            chunks.append(HEADER.pack(ts, c, len(data), zlib.crc32(data) & 0xffffffff))
+            chunks.append(data)
+            self.add(ts, offset, len(data))
+            offsets.append(offset)
+            offset += HEADER.size + len(data)
+        f.write("".join(chunks))
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+        self.size = offset
+        return offsets
+
+    def view(self):
+        if self.mm is None or len(self.mm) < self.size:
+            with open(self.path, "rb") as f:
+                self.mm = mmap.mmap(f.fileno(), self.size, access = mmap.ACCESS_READ)
+        return self.mm
+
+    def records(self, since = None, to = None):
+        """Yields (timestamp, codec, offset, length) of records, skipping ahead
+        with the sparse index and stopping early when the segment is ordered."""
+        if self.size == 0:
+            return
+        mm = self.view()
+        offset = 0
+        if self.ordered and since is not None and self.index:
+            i = bisect_right(self.index, (since, self.size)) - 1
+            if i >= 0:
+                offset = self.index[i][1]
+        end = len(mm)
+        while offset < end:
+            ts, c, length, _ = HEADER.unpack_from(mm, offset)
+            if self.ordered and to is not None and ts >= to:
+                break
+            yield ts, c, offset + HEADER.size, length
+            offset += HEADER.size + length
+
+    def before(self, since, to, after, n):
+        """Up to n records of (since, to) ordered below the (timestamp, offset)
+        key after, newest first. An ordered segment is read backwards one
+        sparse index block at a time, so only about n records are visited."""
+        if not self.ordered:
+            rows = [r for r in self.records(since, to) if since < r[0] < to and (r[0], r[2]) < after]
+            return sorted(rows, key = lambda r: (r[0], r[2]), reverse = True)[:n]
+        rows = []
+        k = bisect_right(self.index, (min(to - 1, after[0]), self.size))
+        while k > 0 and len(rows) < n:
+            k -= 1
+            start = self.index[k][1]
+            end = self.index[k + 1][1] if k + 1 < len(self.index) else self.size
+            rows.extend(r for r in self.block(start, end) if since < r[0] < to and (r[0], r[2]) < after)
+            if self.index[k][0] <= since:
+                break
+        return sorted(rows, key = lambda r: (r[0], r[2]), reverse = True)[:n]
+
+    def block(self, offset, end):
+        mm = self.view()
+        while offset < end:
+            ts, c, length, _ = HEADER.unpack_from(mm, offset)
+            yield ts, c, offset + HEADER.size, length
+            offset += HEADER.size + length
+
+    def release(self):
+        # Buffers handed out by cursors keep the map alive; it is unmapped
+        # once the last of them is gone.
+        self.mm = None
+
+
+class LogStorage(Backend):
+    """Append-only segmented log backend.
+
+    Packets are appended to the newest segment under work/log, which is rolled
+    over once it reaches log_segment_kib. Retention unlinks whole segments.
+    Deleting a range records a tombstone which hides the range from every
+    record written before it; a segment left without live records is unlinked
+    and tombstones older than every segment are forgotten.
+    """
+    def configure(self, conf):
+        self.segmentBytes = conf.get("log_segment_kib", cast = config.positiveInt, default = 128) * 1024
+        self.interval = conf.get("log_index_interval", cast = config.positiveInt, default = 64)
+        self.fsync = conf.get("log_fsync", cast = config.boolean, default = False)
+
+    def open(self):
+        if not os.path.isdir(self.logDir()):
+            os.makedirs(self.logDir())
+        self.segments = []
+        for f in sorted(os.listdir(self.logDir())):
+            m = SEGMENT_FILE.match(f)
+            if m:
+                segment = Segment(int(m.group(1)), os.path.join(self.logDir(), f), self.interval)
+                segment.scan()
+                self.segments.append(segment)
+        self.segments.sort(key = lambda s: s.number)
+        self.tombstones = self.loadTombstones()
+        for segment in self.segments:
+            self.recount(segment)
+        self.active = None
+        self.roll()
+        log.info("Opened {} log segments".format(len(self.segments)))
+
+    def closeStore(self):
+        if self.active is not None:
+            self.active.close()
+            self.active = None
+        for segment in self.segments:
+            segment.release()
+
+    def roll(self, full = False):
+        """Opens the newest segment for appending, starting a new one if it
+        reached log_segment_kib or, with full, can't take the next record."""
+        if self.active is not None:
+            self.active.close()
+        if not self.segments or full or self.segments[-1].size >= self.segmentBytes:
+            number = self.segments[-1].number + 1 if self.segments else 0
+            path = os.path.join(self.logDir(), "{:012d}.log".format(number))
+            self.segments.append(Segment(number, path, self.interval))
+            log.info("Starting log segment {}".format(number))
+        self.active = open(self.segments[-1].path, "ab")
+
+    def write(self, packets):
+        """Appends packets, splitting them across segments so none grows past
+        log_segment_kib, except for a single record larger than that."""
+        seqs = []
+        while packets:
+            segment = self.segments[-1]
+            n = self.fitting(segment.size, packets)
+            if n == 0:
+                self.roll(full = True)
+                continue
+            offsets = segment.append(self.active, packets[:n], self.fsync)
+            # seqs are keyed by payload offset, as page() returns them
+            seqs.extend((segment.number << 32) + offset + HEADER.size for offset in offsets)
+            packets = packets[n:]
+        if self.segments[-1].size >= self.segmentBytes:
+            self.roll()
+        return seqs
+
+    def fitting(self, size, packets):
+        """Number of leading packets a segment of size bytes can take, at
+        least one if it is empty."""
+        empty = size == 0
+        n = 0
+        for _, _, data in packets:
+            size += HEADER.size + len(data)
+            if size > self.segmentBytes and not (empty and n == 0):
+                break
+            n += 1
+        return n
+
+    def count(self, since, to, limit):
+        count = 0
+        for segment in self.covering(since, to):
+            if since < segment.minTs and segment.maxTs < to:
+                count += segment.rows
+                if 0 < limit <= count:
+                    return limit
+                continue
+            for ts, c, offset, length in segment.records(since, to):
+                if since < ts < to and not self.deleted(ts, segment.number, offset):
+                    count += 1
+                    if 0 < limit <= count:
+                        return count
+        return count
+
+    def page(self, since, to, after, n):
+        """Merges the newest n live records below after from every segment.
+        The sequence number of a record is its segment number and offset."""
+        lastTs, lastSeq = after
+        rows = []
+        for segment in self.covering(since, min(to, lastTs + 1)):
+            bound = (lastTs, lastSeq - (segment.number << 32))
+            wanted = n
+            while True:
+                records = segment.before(since, to, bound, wanted)
+                live = [r for r in records if not self.deleted(r[0], segment.number, r[2])]
+                if len(live) >= n or len(records) < wanted:
+                    break
+                wanted *= 2
+            rows.extend((ts, segment.number, c, offset, length) for ts, c, offset, length in live[:n])
+        rows.sort(key = lambda r: (r[0], r[1], r[3]), reverse = True)
+        return [(ts, buffer(self.segment(number).view(), offset, length), c, (number << 32) + offset)
+                for ts, number, c, offset, length in rows[:n]]
+
+    def covering(self, since, to):
+        return [s for s in self.segments if s.rows > 0 and s.maxTs > since and s.minTs < to]
+
+    def segment(self, number):
+        for segment in self.segments:
+            if segment.number == number:
+                return segment
+
+    def remove(self, since, to):
+        position = (self.segments[-1].number, self.segments[-1].size)
+        self.tombstones.append((since, to) + position)
+        count = 0
+        for segment in list(self.segments):
+            if segment.rows == 0 or segment.maxTs < since or segment.minTs > to:
+                continue
+            rows = segment.rows
+            self.recount(segment)
+            count += rows - segment.rows
+            if segment.rows == 0 and segment is not self.segments[-1]:
+                self.drop(segment)
+        self.pruneTombstones()
+        self.saveTombstones()
+        return count
+
+    def vaccum(self):
+        """Unlinks the oldest segments until at least vacuum_percent of packets
+        are gone. The active segment is never dropped."""
+        if not self.overCapacity():
+            return
+        try:
+            with self.writing():
+                target = self.totals()["rows"] * self.vacPercent
+                dropped = 0
+                for segment in self.segments[:-1]:
+                    if dropped >= target:
+                        break
+                    dropped += segment.rows
+                    self.drop(segment)
+                    if segment.maxTs is not None:
+                        self.forget((segment.maxTs, MAX_SEQ))
+                if dropped == 0:
+                    log.error("Storage is over capacity, but there are no old segments to drop. " +
+                              "Verify capacity and log_segment_kib configuration")
+                self.pruneTombstones()
+                self.saveTombstones()
+        except:
+            log.error("Vacuuming log failed", exc_info = 1)
+
+    def drop(self, segment):
+        log.info("Dropping log segment {}".format(segment.number))
+        self.segments.remove(segment)
+        segment.release()
+        try:
+            os.remove(segment.path)
+        except OSError:
+            log.warn("Couldn't remove log segment {}".format(segment.path), exc_info = 1)
+
+    def recount(self, segment):
+        """Recomputes live statistics of a segment, excluding tombstoned records."""
+        if not self.tombstones or segment.size == 0:
+            return
+        rows, size, minTs, maxTs = 0, 0, None, None
+        for ts, _, offset, length in segment.records():
+            if not self.deleted(ts, segment.number, offset):
+                rows += 1
+                size += length
+                minTs = ts if minTs is None else min(minTs, ts)
+                maxTs = ts if maxTs is None else max(maxTs, ts)
+        segment.rows, segment.bytes, segment.minTs, segment.maxTs = rows, size, minTs, maxTs
+
+    def deleted(self, ts, number, offset):
+        for since, to, n, o in self.tombstones:
+            if since <= ts <= to and (number, offset) < (n, o):
+                return True
+        return False
+
+    def pruneTombstones(self):
+        first = self.segments[0].number if self.segments else None
+        self.tombstones = [t for t in self.tombstones if first is not None and (t[2], t[3]) > (first, 0)]
+
+    def loadTombstones(self):
+        try:
+            with open(os.path.join(self.logDir(), TOMBSTONES)) as f:
+                return [tuple(long(v) for v in line.split()) for line in f if line.strip()]
+        except IOError:
+            return []
+
+    def saveTombstones(self):
+        path = os.path.join(self.logDir(), TOMBSTONES)
+        with open(path + ".tmp", "w") as f:
+            for t in self.tombstones:
+                f.write("{} {} {} {}\n".format(*t))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+
+    def totals(self):
+        live = [s for s in self.segments if s.rows > 0]
+        return {
+            "rows": sum(s.rows for s in live),
+            "bytes": sum(s.bytes for s in live),
+            "min_ts": min([s.minTs for s in live] or [None]),
+            "max_ts": max([s.maxTs for s in live] or [None]),
+        }
+
+    def size(self):
+        return sum(s.size for s in self.segments) / 1024
+
+    @staticmethod
+    def logDir():
+        return os.path.join(config.workDir, "log")
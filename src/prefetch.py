@@ -0,0 +1,279 @@
+import threading, logging, zlib
+from collections import OrderedDict
+from Queue import Queue, Empty, Full
+
+import wire, framing
+
+log = logging.getLogger("btserver")
+
+
+class Frame:
+    """A serialized Response ready to be sent: the chunks to write, the
+    number of packets it carries, their timestamp range and the continuation
+    token of the query after them."""
+    def __init__(self, count, frm, to, chunks, token = None):
+        self.count = count
+        self.frm = frm
+        self.to = to
+        self.chunks = chunks
+        self.size = sum(len(c) for c in chunks)
+        self.token = token
+
+
+class FrameCache:
+    """Byte-capped LRU of serialized Responses shared by all transfers, so
+    clients asking for the same range at the same time or one after another
+    are served from memory.
+
+    An entry is (count, frm, to, data, token) and is keyed by the position
+    of the query the Response starts at (its continuation token), the batch,
+    `full` and whether the Response carries noPackets. Entries are only valid
+    for the storage version they were read at; storing one of a newer version
+    drops all the others, which can't be hit anymore.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.version = None
+        self.lock = threading.Lock()
+
+    def get(self, version, key):
+        with self.lock:
+            if version != self.version:
+                return None
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def put(self, version, key, entry):
+        size = len(entry[3])
+        with self.lock:
+            if version != self.version:
+                if self.version is not None and version < self.version:
+                    return
+                self.entries.clear()
+                self.bytes = 0
+                self.version = version
+            if key in self.entries or size > self.capacity:
+                return
+            self.entries[key] = entry
+            self.bytes += size
+            while self.bytes > self.capacity:
+                _, evicted = self.entries.popitem(last = False)
+                self.bytes -= len(evicted[3])
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Deflater:
+    """Compresses the Responses of a transfer as one zlib stream, flushed at
+    the end of every frame: each frame inflates as soon as it arrives, and
+    later frames are compressed against the history of earlier ones."""
+    def __init__(self, codec, level = 6):
+        self.codec = codec
+        self.compressor = zlib.compressobj(level)
+        self.raw = 0
+        self.compressed = 0
+
+    def frame(self, segments):
+        data = "".join(str(s) for s in segments)
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.raw += len(data)
+        self.compressed += len(compressed)
+        return wire.compressed(compressed, self.codec)
+
+    def summary(self):
+        return "deflated {} to {} bytes ({:.1f}%)".format(
+            self.raw, self.compressed, 100.0 * self.compressed / self.raw if self.raw else 100.0)
+
+
+class BatchSizer:
+    """Chooses the number of packets of each Response.
+
+    A fixed sizer always returns its batch. An adaptive one sizes frames to
+    fit a byte budget: frameBytes, further limited to what the link is seen
+    to send in frameSeconds. Packet sizes are learnt from produced frames
+    and link throughput from timed sends, both as moving averages.
+    """
+    SMOOTHING = 0.3
+
+    def __init__(self, batch, adaptive = False, frameBytes = 64 * 1024, frameSeconds = 0.25, maxBatch = 1000):
+        self.batch = batch
+        self.adaptive = adaptive
+        self.frameBytes = frameBytes
+        self.frameSeconds = frameSeconds
+        self.maxBatch = maxBatch
+        self.packetBytes = None
+        self.rate = None
+        self.sizes = []
+
+    def next(self):
+        if self.adaptive and self.packetBytes:
+            budget = self.frameBytes
+            if self.rate:
+                budget = min(budget, self.rate * self.frameSeconds)
+            self.batch = max(1, min(self.maxBatch, int(budget / self.packetBytes)))
+        self.sizes.append(self.batch)
+        return self.batch
+
+    def produced(self, frame):
+        if frame.count > 0:
+            self.packetBytes = self.average(self.packetBytes, float(frame.size) / frame.count)
+
+    def sent(self, frame, seconds):
+        if frame.count > 0 and seconds > 0:
+            self.rate = self.average(self.rate, frame.size / seconds)
+            log.debug("Sent {} packets, {} bytes in {:.3f}s".format(frame.count, frame.size, seconds))
+
+    def average(self, current, value):
+        return value if current is None else current + self.SMOOTHING * (value - current)
+
+    def stats(self):
+        sizes = self.sizes[:-1] or self.sizes
+        return {
+            "frames": len(sizes),
+            "min_batch": min(sizes) if sizes else 0,
+            "max_batch": max(sizes) if sizes else 0,
+            "avg_batch": float(sum(sizes)) / len(sizes) if sizes else 0.0,
+            "link_bps": int(self.rate or 0),
+        }
+
+    def summary(self):
+        return "{frames} frames, batch {min_batch}-{max_batch} (avg {avg_batch:.1f}), link {link_bps} B/s".format(
+            **self.stats())
+
+
+class Prefetcher(threading.Thread):
+    """Fetches and serializes the Response frames of a transfer ahead of the
+    socket writer, keeping up to `depth` of them in a bounded queue, so
+    storage reads and serialization overlap with sending. With depth 0
+    frames are produced on demand by the caller's thread.
+
+    The last frame of a transfer carries no packets. With a deflater every
+    frame is compressed, and with a FrameCache Responses are looked up there
+    before being read from storage.
+    """
+    def __init__(self, storage, dbConnId, sizer, full, packetCount, depth, deflater = None, cache = None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.storage = storage
+        self.dbConnId = dbConnId
+        self.sizer = sizer
+        self.full = full
+        self.packetCount = packetCount
+        self.initial = True
+        self.depth = depth
+        self.deflater = deflater
+        self.cache = cache
+        self.frames = Queue(depth) if depth > 0 else None
+        self.stopped = threading.Event()
+
+    def produce(self):
+        n = self.sizer.next()
+        if self.cache is None:
+            count, frm, to, segments, token = self.read(n)
+        else:
+            count, frm, to, segments, token = self.cached(n)
+        if count > 0:
+            self.initial = False
+        if self.deflater is not None:
+            segments = self.deflater.frame(segments)
+        frame = Frame(count, frm, to, framing.coalesce(segments), token)
+        self.sizer.produced(frame)
+        return frame
+
+    def read(self, n):
+        """Fetches and serializes the next Response. Returns its packet count,
+        timestamp range, segments and the continuation token after it."""
+        packets = self.storage.fetch(self.dbConnId, n = n, encoded = True)
+        noPackets = self.packetCount if packets and self.initial else None
+        segments = wire.response(packets, self.full, noPackets)
+        if not packets:
+            return 0, None, None, segments, None
+        return len(packets), packets[-1][0], packets[0][0], segments, self.storage.token(self.dbConnId)
+
+    def cached(self, n):
+        """Same as read, through the frame cache. A Response is only cached if
+        storage didn't change while it was read."""
+        version = self.storage.version
+        key = (self.storage.token(self.dbConnId), n, self.full, self.initial)
+        if key[0] is None:
+            return self.read(n)
+        entry = self.cache.get(version, key)
+        if entry is not None:
+            count, frm, to, data, token = entry
+            self.storage.seek(self.dbConnId, token)
+            return count, frm, to, [data], token
+        count, frm, to, segments, token = self.read(n)
+        if count == 0:
+            return count, frm, to, segments, token
+        data = "".join(str(s) for s in segments)
+        if self.storage.version == version:
+            self.cache.put(version, key, (count, frm, to, data, token))
+        return count, frm, to, [data], token
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                frame = self.produce()
+                self.put(frame)
+                if frame.count == 0:
+                    break
+        except Exception as e:
+            log.exception("Failed to prepare response")
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.frames.put(item, timeout = 0.1)
+                return
+            except Full:
+                pass
+
+    def next(self, timeout):
+        """Next frame, or None if none got ready within timeout. Re-raises
+        errors of the producing thread."""
+        if self.frames is None:
+            return self.produce()
+        try:
+            item = self.frames.get(timeout = timeout)
+        except Empty:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def begin(self):
+        if self.frames is not None:
+            self.start()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def pushFrames(packets, sizer, full, deflater = None):
+    """Frames of a transfer pushed to a subscriber: (timestamp, data) packets
+    in memory, sent newest first and sized like Prefetcher frames, ending
+    with one carrying no packets."""
+    packets = sorted(packets, key = lambda p: p[0], reverse = True)
+    frames = []
+    i = 0
+    while True:
+        batch = packets[i:i + sizer.next()]
+        fields = [(t, (wire.dataHeader(d), d)) for t, d in batch]
+        segments = wire.response(fields, full, len(packets) if batch and i == 0 else None)
+        i += len(batch)
+        if deflater is not None:
+            segments = deflater.frame(segments)
+        if batch:
+            frame = Frame(len(batch), batch[-1][0], batch[0][0], framing.coalesce(segments))
+        else:
+            frame = Frame(0, None, None, framing.coalesce(segments))
+        sizer.produced(frame)
+        frames.append(frame)
+        if not batch:
+            return frames
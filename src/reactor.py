@@ -0,0 +1,568 @@
+import os, errno, select, threading, logging, time
+from collections import deque
+from Queue import Queue, Empty
+
+import bt_pb2, wire, framing
+from connection import InvalidRequest, MAX_REQUEST, parseRequest, parseAck, errorFrame, reject, since, covered
+from checkpoints import Progress, requestKey
+from framing import FrameError, parseVarint
+from prefetch import Prefetcher, Frame, pushFrames
+from subscriptions import Subscription
+
+log = logging.getLogger("btserver")
+
+READ = 1
+WRITE = 2
+ACCEPT_PAUSE = 1.0
+
+
+class Executor:
+    """Fixed pool of worker threads running blocking storage calls on behalf
+    of the reactor. Outcomes are handed back with done(callback, result, error)."""
+    def __init__(self, workers, done):
+        self.tasks = Queue()
+        self.done = done
+        self.threads = [threading.Thread(target = self.work) for _ in range(workers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def submit(self, fn, args, callback):
+        self.tasks.put((fn, args, callback))
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            fn, args, callback = task
+            try:
+                self.done(callback, fn(*args), None)
+            except Exception as e:
+                self.done(callback, None, e)
+
+    def shutdown(self):
+        for _ in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+
+
+class Poller:
+    """Readiness notification for file descriptors, on epoll where the
+    platform has it and on select elsewhere."""
+    def __init__(self):
+        self.epoll = select.epoll() if hasattr(select, "epoll") else None
+        self.fds = {}
+
+    def register(self, fd, mask):
+        if self.epoll is not None:
+            if fd in self.fds:
+                self.epoll.modify(fd, self.epollMask(mask))
+            else:
+                self.epoll.register(fd, self.epollMask(mask))
+        self.fds[fd] = mask
+
+    def unregister(self, fd):
+        if self.fds.pop(fd, None) is not None and self.epoll is not None:
+            self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        """Returns (fd, mask) of ready descriptors; errors and hang-ups are
+        reported as readable so the next recv surfaces them."""
+        if self.epoll is not None:
+            events = []
+            for fd, ev in self.epoll.poll(timeout):
+                mask = READ if ev & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP) else 0
+                if ev & select.EPOLLOUT:
+                    mask |= WRITE
+                events.append((fd, mask))
+            return events
+        readers = [fd for fd, m in self.fds.iteritems() if m & READ]
+        writers = [fd for fd, m in self.fds.iteritems() if m & WRITE]
+        r, w, x = select.select(readers, writers, readers, timeout)
+        ready = {}
+        for fd in r + x:
+            ready[fd] = READ
+        for fd in w:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        return ready.items()
+
+    def close(self):
+        if self.epoll is not None:
+            self.epoll.close()
+
+    @staticmethod
+    def epollMask(mask):
+        return ((select.EPOLLIN if mask & READ else 0) |
+                (select.EPOLLOUT if mask & WRITE else 0))
+
+
+def wouldBlock(e):
+    code = getattr(e, "errno", None) or (e.args[0] if e.args and isinstance(e.args[0], int) else None)
+    return code in (errno.EAGAIN, errno.EWOULDBLOCK) or "temporarily unavailable" in str(e)
+
+
+class Session:
+    """One client served by the reactor: the same exchange as Connection,
+    driven by socket readiness and executor completions instead of blocking
+    calls.
+
+        request     read the length prefixed Request
+        stream      send Response frames, preparing the next ones on the
+                    executor while up to `prefetch` frames wait to be written,
+                    and take the client's acknowledgements
+        count       read the number of packets the client received, or its
+                    last acknowledgement
+        idle        subscribed: wait for packets to be stored and push them
+                    as a transfer of their own, back to count
+        closing     send what is left and wait for the client to hang up,
+                    as Connection.shutdownSock does
+    """
+    def __init__(self, reactor, sock, address):
+        self.reactor = reactor
+        self.storage = reactor.storage
+        self.sock = sock
+        self.address = address
+        self.fd = sock.fileno()
+        self.inbuf = ""
+        self.outbuf = deque()
+        self.queued = 0
+        self.sendStart = time.time()
+        self.stats = {}
+        self.state = "request"
+        self.pending = False
+        self.dbConnId = None
+        self.packetCount = 0
+        self.progress = None
+        self.completed = False
+        self.sync = True
+        self.subscription = None
+        self.touch()
+
+    def touch(self):
+        self.deadline = time.time() + self.reactor.timeout
+
+    def expired(self, now):
+        return not self.pending and self.state != "idle" and now > self.deadline
+
+    def interest(self):
+        return READ | (WRITE if self.outbuf else 0)
+
+    def onReadable(self):
+        try:
+            data = self.sock.recv(framing.RECV_BYTES)
+        except Exception as e:
+            if wouldBlock(e):
+                return
+            if self.state == "idle" or self.state == "closing":
+                log.info("Client {} hung up: {}".format(self.address, e))
+                self.close()
+                return
+            raise
+        if not data:
+            if self.state == "idle":
+                log.info("Subscriber {} disconnected".format(self.address))
+            elif self.state != "closing":
+                log.warn("Client {} disconnected".format(self.address))
+            self.close()
+            return
+        self.touch()
+        if self.state == "closing":
+            self.close()
+            return
+        self.inbuf += data
+        self.process()
+
+    def onWritable(self):
+        while self.outbuf:
+            segment = self.outbuf[0]
+            if isinstance(segment, Frame):
+                # end of a Response frame
+                self.outbuf.popleft()
+                self.queued -= 1
+                now = time.time()
+                self.sizer.sent(segment, now - self.sendStart)
+                self.progress.sent(segment)
+                self.sendStart = now
+                continue
+            try:
+                sent = self.sock.send(segment)
+            except Exception as e:
+                if wouldBlock(e):
+                    return
+                raise
+            self.touch()
+            if sent < len(segment):
+                self.outbuf[0] = buffer(segment, sent)
+                return
+            self.outbuf.popleft()
+        self.fetch()
+
+    def process(self):
+        if self.pending:
+            return
+        if self.state == "request":
+            frame = self.readFrame()
+            if frame is not None:
+                request = parseRequest(frame)
+                self.batch = request.batch
+                self.full = request.full
+                self.ackEvery = request.ackEvery
+                self.codecs = list(request.codecs)
+                key = requestKey(request)
+                resumed = self.reactor.checkpoints.take(self.address, key) if request.resume else None
+                self.progress = Progress(key, self.ackEvery > 0, resumed)
+                self.request = request
+                self.resumed = resumed
+                frm = since(self.storage, self.address, request)
+                if request.subscribe:
+                    self.subscription = Subscription(frm, request.to, self.reactor.subscribeBuffer, self.wake)
+                if resumed is not None:
+                    self.submit(self.storage.resume, (resumed.token, self.subscription), self.onQuery)
+                else:
+                    self.submit(self.storage.get, (frm, request.to, request.limit, self.subscription),
+                                self.onQuery)
+        elif self.state == "stream" and self.ackEvery > 0:
+            self.readAcks()
+        elif self.state == "count":
+            n = self.readAcks() if self.ackEvery > 0 else self.readVarint()
+            if n is not None:
+                self.onCount(n)
+        elif self.state == "idle":
+            if self.inbuf:
+                raise InvalidRequest("Unexpected message from subscriber")
+            self.push()
+
+    def readAcks(self):
+        """Takes the acknowledgements received so far. Returns the number of
+        packets received once the last one is in, otherwise None."""
+        while True:
+            frame = self.readFrame()
+            if frame is None:
+                return None
+            ack = parseAck(frame)
+            self.progress.ack(ack)
+            if ack.last:
+                return ack.received
+
+    def readVarint(self):
+        parsed = parseVarint(self.inbuf)
+        if parsed is None:
+            return None
+        self.inbuf = self.inbuf[parsed[1]:]
+        return parsed[0]
+
+    def readFrame(self):
+        parsed = parseVarint(self.inbuf)
+        if parsed is None:
+            return None
+        n, start = parsed
+        if n > MAX_REQUEST:
+            raise InvalidRequest("Request too long")
+        if len(self.inbuf) < start + n:
+            return None
+        frame, self.inbuf = self.inbuf[start:start + n], self.inbuf[start + n:]
+        return frame
+
+    def submit(self, fn, args, callback):
+        self.pending = True
+        self.reactor.executor.submit(fn, args, lambda result, error: self.onDone(callback, result, error))
+
+    def onDone(self, callback, result, error):
+        self.pending = False
+        self.touch()
+        if self.sock is None:
+            if callback == self.onQuery and result is not None and result[0] is not None:
+                self.storage.closeConn(result[0])
+            if self.subscription is not None:
+                self.storage.unsubscribe(self.subscription)
+            return
+        if error is not None:
+            log.error("Storage call failed for client {}".format(self.address), exc_info = error)
+            self.fail(bt_pb2.Error.INTERNAL_ERROR, "Database error")
+            return
+        try:
+            callback(result)
+            self.process()
+        except (InvalidRequest, FrameError) as e:
+            log.warn("Invalid bluetooth request: " + str(e))
+            self.fail(bt_pb2.Error.INVALID_REQUEST, str(e))
+        except:
+            log.exception("Unexpected error during bluetooth comms")
+            self.close()
+            return
+        self.reactor.update(self)
+
+    def onQuery(self, result):
+        self.dbConnId, self.packetCount = result
+        if self.dbConnId is None:
+            self.fail(bt_pb2.Error.INTERNAL_ERROR, "Database error")
+            return
+        self.sync = covered(self.request, self.resumed, self.packetCount)
+        self.sizer = self.reactor.batchSizer(self.batch)
+        self.deflater = self.reactor.deflater(self.codecs)
+        self.producer = Prefetcher(self.storage, self.dbConnId, self.sizer, self.full, self.packetCount, 0,
+                                   self.deflater, self.reactor.frameCache)
+        self.state = "stream"
+        self.fetch()
+
+    def fetch(self):
+        if self.state == "stream" and not self.pending and self.queued < max(self.reactor.prefetch, 1):
+            self.submit(self.producer.produce, (), self.onFrame)
+
+    def onFrame(self, frame):
+        if not self.outbuf:
+            self.sendStart = time.time()
+        self.outbuf.extend(frame.chunks)
+        self.outbuf.append(frame)
+        self.queued += 1
+        if frame.count == 0:
+            self.storage.closeConn(self.dbConnId)
+            self.dbConnId = None
+            self.state = "count"
+            self.stats = self.sizer.stats()
+            log.info("Transfer: " + self.sizer.summary())
+            if self.deflater is not None:
+                log.info("Transfer: " + self.deflater.summary())
+        else:
+            self.fetch()
+
+    def onCount(self, n):
+        if n != self.packetCount:
+            log.warn("Client did not respond with correct number of packets. Expected: {}, actual: {}".
+                     format(self.packetCount, n))
+            self.outbuf.append(wire.varint(0))
+            self.finish()
+            return
+        self.completed = True
+        self.reactor.checkpoints.remove(self.address)
+        log.info("{} packets sent".format(n))
+        if self.sync and self.packetCount > 0:
+            self.submit(self.storage.synced, (self.address, self.progress.to), self.onSynced)
+        else:
+            self.onSynced(None)
+
+    def onSynced(self, result):
+        self.outbuf.append(wire.varint(1))
+        if self.reactor.delSent and self.packetCount > 0:
+            self.submit(self.storage.delete, self.progress.timerange(), lambda result: None)
+        self.finish()
+
+    def finish(self):
+        """Ends a confirmed transfer: the client hangs up, unless it
+        subscribed."""
+        if self.subscription is None:
+            log.info("Finishing communications")
+            self.state = "closing"
+            return
+        if not self.completed:
+            self.interrupted()
+            self.completed = True
+        self.state = "idle"
+        self.push()
+
+    def wake(self):
+        """Called from the ingest thread when packets were queued for the
+        subscriber."""
+        self.reactor.complete(self.onNotified, None, None)
+
+    def onNotified(self, result, error):
+        if self.sock is None:
+            return
+        try:
+            self.push()
+        except:
+            log.exception("Unexpected error during bluetooth comms")
+            self.close()
+            return
+        self.reactor.update(self)
+
+    def push(self):
+        """Queues a transfer of the packets stored since the last one, as
+        Connection.push does, once the previous one is confirmed."""
+        if self.state != "idle" or self.pending:
+            return
+        packets = self.subscription.take()
+        if packets is None:
+            self.fail(bt_pb2.Error.INTERNAL_ERROR, "Subscriber fell too far behind")
+            return
+        if not packets:
+            return
+        self.packetCount = len(packets)
+        self.progress = Progress(self.progress.key)
+        self.touch()
+        if not self.outbuf:
+            self.sendStart = time.time()
+        for frame in pushFrames(packets, self.sizer, self.full, self.reactor.deflater(self.codecs)):
+            self.outbuf.extend(frame.chunks)
+            self.outbuf.append(frame)
+            self.queued += 1
+        self.state = "count"
+
+    def fail(self, code, desc):
+        self.outbuf.append(errorFrame(code, desc))
+        self.state = "closing"
+
+    def interrupted(self):
+        """Checkpoints a transfer the client didn't complete, as
+        Connection.interrupted does."""
+        checkpoint = self.reactor.checkpoints.save(self.address, self.progress)
+        if checkpoint is not None and self.reactor.delSent and checkpoint.frm < checkpoint.to:
+            self.reactor.executor.submit(self.storage.delete, (checkpoint.frm + 1, checkpoint.to),
+                                         lambda result, error: None)
+
+    def close(self):
+        if self.subscription is not None:
+            self.storage.unsubscribe(self.subscription)
+        if self.dbConnId is not None:
+            self.storage.closeConn(self.dbConnId)
+            self.dbConnId = None
+        if self.progress is not None and not self.completed:
+            self.interrupted()
+            self.progress = None
+        if self.sock is not None:
+            self.reactor.remove(self)
+            try:
+                self.sock.close()
+            except:
+                pass
+            self.sock = None
+
+
+class Reactor:
+    """Serves every bluetooth client from a single thread.
+
+    Client sockets are non-blocking and multiplexed with epoll (select where
+    epoll isn't available); storage calls run on a small executor whose
+    completions wake the loop through a pipe. At most max_sessions clients
+    are served at once, further ones are turned away with an error.
+    """
+    def __init__(self, btserver, serverSock):
+        self.btserver = btserver
+        self.storage = btserver.storage
+        self.timeout = btserver.timeout
+        self.delSent = btserver.delSent
+        self.maxSessions = btserver.maxSessions
+        self.batchSizer = btserver.batchSizer
+        self.deflater = btserver.deflater
+        self.frameCache = btserver.frameCache
+        self.prefetch = btserver.prefetch
+        self.checkpoints = btserver.checkpoints
+        self.subscribeBuffer = btserver.subscribeBuffer
+        self.serverSock = serverSock
+        self.acceptPaused = None
+        self.sessions = {}
+        self.completions = Queue()
+        self.wakeRead, self.wakeWrite = os.pipe()
+        self.poller = Poller()
+        self.executor = Executor(btserver.workers, self.complete)
+
+    def complete(self, callback, result, error):
+        self.completions.put((callback, result, error))
+        try:
+            os.write(self.wakeWrite, "x")
+        except OSError:
+            pass
+
+    def run(self):
+        self.poller.register(self.serverSock.fileno(), READ)
+        self.poller.register(self.wakeRead, READ)
+        try:
+            while self.btserver.running:
+                for fd, mask in self.poller.poll(0.1):
+                    if fd == self.serverSock.fileno():
+                        self.accept()
+                    elif fd == self.wakeRead:
+                        self.drain()
+                    else:
+                        self.dispatch(fd, mask)
+                self.expire()
+                if self.acceptPaused is not None and time.time() >= self.acceptPaused:
+                    self.acceptPaused = None
+                    self.poller.register(self.serverSock.fileno(), READ)
+        finally:
+            self.close()
+
+    def accept(self):
+        """Takes a client off the listening socket. A failure to accept only
+        concerns that client; after any other than a spurious wake-up the
+        listener is left alone for ACCEPT_PAUSE seconds, so running out of
+        file descriptors doesn't spin the loop."""
+        try:
+            client_sock, client_info = self.serverSock.accept()
+        except IOError as e:
+            # socket.error, or BluetoothError on RFCOMM
+            if not wouldBlock(e):
+                log.warn("Couldn't accept connection: {}".format(e))
+                self.poller.unregister(self.serverSock.fileno())
+                self.acceptPaused = time.time() + ACCEPT_PAUSE
+            return
+        log.info("Accepted connection from: " + str(client_info))
+        if len(self.sessions) >= self.maxSessions:
+            client_sock.settimeout(self.timeout)
+            reject(client_sock, "Too many sessions")
+            return
+        try:
+            client_sock.setblocking(0)
+            self.btserver.transport.accepted(client_sock)
+        except IOError as e:
+            log.warn("Couldn't set up connection from {}: {}".format(client_info, e))
+            client_sock.close()
+            return
+        session = Session(self, client_sock, self.btserver.transport.address(client_info))
+        self.sessions[session.fd] = session
+        self.update(session)
+
+    def drain(self):
+        try:
+            os.read(self.wakeRead, framing.RECV_BYTES)
+        except OSError:
+            pass
+        while True:
+            try:
+                callback, result, error = self.completions.get_nowait()
+            except Empty:
+                break
+            callback(result, error)
+
+    def dispatch(self, fd, mask):
+        session = self.sessions.get(fd)
+        if session is None:
+            return
+        try:
+            if mask & WRITE:
+                session.onWritable()
+            if mask & READ and session.sock is not None:
+                session.onReadable()
+            self.update(session)
+        except (InvalidRequest, FrameError) as e:
+            log.warn("Invalid bluetooth request: " + str(e))
+            session.fail(bt_pb2.Error.INVALID_REQUEST, str(e))
+            self.update(session)
+        except:
+            log.exception("Unexpected error during bluetooth comms")
+            session.close()
+
+    def update(self, session):
+        if session.sock is not None:
+            self.poller.register(session.fd, session.interest())
+
+    def remove(self, session):
+        self.poller.unregister(session.fd)
+        self.sessions.pop(session.fd, None)
+
+    def expire(self):
+        now = time.time()
+        for session in self.sessions.values():
+            if session.expired(now):
+                log.warn("Client {} timed out".format(session.address))
+                session.close()
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.executor.shutdown()
+        self.poller.close()
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
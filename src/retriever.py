@@ -89,7 +89,9 @@ class Retriever(threading.Thread):
                     packets.append((timestamp, data))
                     log.debug("Inserting data from file [{}]".format(f))
                 
-            self.storage.put(packets)
+            if not self.storage.put(packets, sync = True):
+                log.error("Packets were not stored, keeping {} files for the next run".format(len(files)))
+                return
             for f in files:
                 try:
                     remove(join(self.feed, f))
@@ -0,0 +1,84 @@
+import threading
+from collections import deque
+
+
+class Ticket:
+    def __init__(self, write):
+        self.write = write
+        self.expired = False
+
+
+class RWLock:
+    """Fair reader/writer lock built on a single Condition.
+
+    Waiters are queued in arrival order. A writer is admitted when it is at the
+    head of the queue and nobody holds the lock; a reader is admitted as soon as
+    no writer holds the lock and no writer is queued ahead of it, so consecutive
+    readers run concurrently but cannot starve a waiting writer.
+
+    Releasing the lock notifies waiters immediately. Timeouts are delivered by
+    a Timer which is only started once a caller actually has to block.
+    """
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.queue = deque()
+
+    def acquireRead(self, timeout = None):
+        return self.acquire(False, timeout)
+
+    def acquireWrite(self, timeout = None):
+        return self.acquire(True, timeout)
+
+    def releaseRead(self):
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def releaseWrite(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+    def acquire(self, write, timeout):
+        ticket = Ticket(write)
+        timer = None
+        with self.cond:
+            self.queue.append(ticket)
+            try:
+                while not self.ready(ticket):
+                    if ticket.expired or (timeout is not None and timeout <= 0):
+                        return False
+                    if timer is None and timeout is not None:
+                        timer = threading.Timer(timeout, self.expire, [ticket])
+                        timer.daemon = True
+                        timer.start()
+                    self.cond.wait()
+                if write:
+                    self.writer = True
+                else:
+                    self.readers += 1
+                return True
+            finally:
+                self.queue.remove(ticket)
+                self.cond.notify_all()
+                if timer is not None:
+                    timer.cancel()
+
+    def ready(self, ticket):
+        if self.writer:
+            return False
+        if ticket.write:
+            return self.readers == 0 and self.queue[0] is ticket
+        for t in self.queue:
+            if t is ticket:
+                return True
+            if t.write:
+                return False
+
+    def expire(self, ticket):
+        with self.cond:
+            ticket.expired = True
+            self.cond.notify_all()
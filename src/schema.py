@@ -0,0 +1,78 @@
+import logging
+
+log = logging.getLogger("storage")
+
+
+class SchemaError(Exception): pass
+
+
+def v0to1(conn):
+    legacy = conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'packets'").fetchone()[0]
+    if legacy:
+        conn.execute("ALTER TABLE packets RENAME TO packets_v0")
+    conn.execute("CREATE TABLE packets (id INTEGER PRIMARY KEY, timestamp INT8 NOT NULL, data BLOB)")
+    if legacy:
+        conn.execute("INSERT INTO packets (timestamp, data) " +
+                     "SELECT coalesce(timestamp, 0), data FROM packets_v0 ORDER BY timestamp ASC")
+        conn.execute("DROP TABLE packets_v0")
+    conn.execute("CREATE INDEX packets_timestamp ON packets (timestamp)")
+
+
+def v1to2(conn):
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value INT8)")
+    conn.execute("INSERT INTO meta SELECT 'rows', count(*) FROM packets")
+    conn.execute("INSERT INTO meta SELECT 'bytes', coalesce(sum(length(data)), 0) FROM packets")
+    conn.execute("INSERT INTO meta SELECT 'min_ts', min(timestamp) FROM packets")
+    conn.execute("INSERT INTO meta SELECT 'max_ts', max(timestamp) FROM packets")
+
+
+def v2to3(conn):
+    conn.execute("ALTER TABLE packets ADD COLUMN codec INTEGER NOT NULL DEFAULT 0")
+
+
+def v3to4(conn):
+    conn.execute("CREATE TABLE blobs (hash BLOB PRIMARY KEY, codec INTEGER NOT NULL, data BLOB, refs INTEGER NOT NULL)")
+    conn.execute("ALTER TABLE packets ADD COLUMN hash BLOB")
+    conn.execute("CREATE TRIGGER packets_unref AFTER DELETE ON packets WHEN old.hash IS NOT NULL BEGIN " +
+                 "UPDATE blobs SET refs = refs - 1 WHERE hash = old.hash; " +
+                 "UPDATE meta SET value = value - coalesce(" +
+                 "(SELECT length(data) FROM blobs WHERE hash = old.hash AND refs <= 0), 0) WHERE key = 'bytes'; " +
+                 "DELETE FROM blobs WHERE hash = old.hash AND refs <= 0; " +
+                 "END")
+
+
+MIGRATIONS = [v0to1, v1to2, v2to3, v3to4]
+VERSION = len(MIGRATIONS)
+INCREMENTAL = 2
+
+
+def version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    """Brings the database up to the current schema version and makes sure
+    freed pages can be reclaimed with incremental_vacuum.
+
+    Every step runs in its own transaction together with the user_version bump,
+    so an interrupted migration leaves the file at the last completed version.
+    The connection must be in autocommit mode (isolation_level = None).
+    """
+    current = version(conn)
+    if current > VERSION:
+        raise SchemaError("Database schema version {} is newer than supported {}".format(current, VERSION))
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    for v in range(current, VERSION):
+        log.info("Migrating database schema from version {} to {}".format(v, v + 1))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            MIGRATIONS[v](conn)
+            conn.execute("PRAGMA user_version = {}".format(v + 1))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != INCREMENTAL:
+        log.info("Enabling incremental vacuum, rebuilding database")
+        conn.execute("VACUUM")
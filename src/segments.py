@@ -0,0 +1,159 @@
+import os, re, logging
+
+import config
+from storage import Storage
+from cache import MAX_SEQ
+
+log = logging.getLogger("storage")
+
+WINDOWS = {
+    "hour": 3600 * 1000,
+    "day": 24 * 3600 * 1000,
+}
+SEGMENT_FILE = re.compile(r"^(\d+)\.db$")
+
+
+class SegmentStorage(Storage):
+    """Storage partitioned into one SQLite file per time window.
+
+    Segment files live in work/segments and are named after the first
+    millisecond of their window. Range queries only touch segments overlapping
+    the range, and capacity eviction unlinks whole segments, oldest first,
+    without deleting rows or vacuuming.
+    """
+    def open(self):
+        conf = config.getSub("storage")
+        self.window = WINDOWS[conf.get("partition", cast = config.choice(*WINDOWS), default = "day")]
+        self.segmentReaders = conf.get("segment_readers", cast = config.positiveInt, default = 2)
+        self.segments = {}
+        self.segmentStats = {}
+
+        if not os.path.isdir(self.segmentDir()):
+            os.makedirs(self.segmentDir())
+        for f in os.listdir(self.segmentDir()):
+            m = SEGMENT_FILE.match(f)
+            if m:
+                start = long(m.group(1))
+                self.segments[start] = self.openDb(self.segmentFile(start), self.segmentReaders)
+                self.segmentStats[start] = self.loadStats(self.segments[start].writer)
+        log.info("Opened {} segments".format(len(self.segments)))
+
+    def closeStore(self):
+        for db in self.segments.values():
+            db.close()
+
+    def write(self, packets):
+        windows = {}
+        for i, p in enumerate(packets):
+            windows.setdefault(p[0] - p[0] % self.window, []).append(i)
+        seqs = [None] * len(packets)
+        for start in sorted(windows):
+            db = self.segments.get(start)
+            if db is None:
+                log.info("Creating segment {}".format(start))
+                db = self.openDb(self.segmentFile(start), self.segmentReaders)
+                self.segments[start] = db
+            with db.writer as conn:
+                ids = self.insertRows(conn, [packets[i] for i in windows[start]])
+                self.segmentStats[start] = self.loadStats(conn)
+            for i, seq in zip(windows[start], ids):
+                seqs[i] = seq
+        return seqs
+
+    def count(self, since, to, limit):
+        count = 0
+        for start in self.overlapping(since, to):
+            n = self.spanned(self.segmentStats[start], since, to)
+            if n is None:
+                with self.reader(self.segments[start]) as conn:
+                    n = self.countRange(conn, since, to, limit - count if limit > 0 else 0)
+            count += n
+            if 0 < limit <= count:
+                return limit
+        return count
+
+    def page(self, since, to, after, n):
+        """Segments cover disjoint windows, so a page is read from the segment
+        holding the after key and then from older segments until it is full."""
+        rows = []
+        for start in self.overlapping(since, min(to, after[0] + 1)):
+            with self.reader(self.segments[start]) as conn:
+                rows.extend(self.selectPage(conn, since, to, after, n - len(rows)))
+            if len(rows) >= n:
+                break
+        return rows
+
+    def remove(self, since, to):
+        count = 0
+        for start in self.overlapping(since, to):
+            if since <= start and start + self.window - 1 <= to:
+                count += self.segmentStats[start]["rows"]
+                self.drop(start)
+            else:
+                with self.segments[start].writer as conn:
+                    count += self.deleteRange(conn, since, to)
+                    self.segmentStats[start] = self.loadStats(conn)
+        return count
+
+    def vaccum(self):
+        """Drops the oldest segments until at least vacuum_percent of packets
+        are gone. The newest segment is never dropped."""
+        if not self.overCapacity():
+            return
+        try:
+            with self.writing():
+                target = self.totals()["rows"] * self.vacPercent
+                dropped = 0
+                for start in sorted(self.segments)[:-1]:
+                    if dropped >= target:
+                        break
+                    dropped += self.segmentStats[start]["rows"]
+                    self.drop(start)
+                    self.forget((start + self.window - 1, MAX_SEQ))
+                if dropped == 0:
+                    log.error("Storage is over capacity, but there are no old segments to drop. " +
+                              "Verify capacity and partition configuration")
+        except:
+            log.error("Vacuuming segments failed", exc_info = 1)
+
+    def drop(self, start):
+        log.info("Dropping segment {}".format(start))
+        db = self.segments.pop(start)
+        del self.segmentStats[start]
+        db.close()
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.segmentFile(start) + suffix)
+            except OSError:
+                pass
+
+    def totals(self):
+        stats = self.segmentStats.values()
+        return {
+            "rows": sum(s["rows"] for s in stats),
+            "bytes": sum(s["bytes"] for s in stats),
+            "min_ts": min([s["min_ts"] for s in stats if s["min_ts"] is not None] or [None]),
+            "max_ts": max([s["max_ts"] for s in stats if s["max_ts"] is not None] or [None]),
+        }
+
+    def size(self):
+        try:
+            size = 0
+            for db in self.segments.values():
+                with self.reader(db) as conn:
+                    size += self.usedKiB(conn)
+            return size
+        except:
+            log.warn("Failed to evaluate storage size", exc_info = 1)
+            return 0
+
+    def overlapping(self, since, to):
+        return sorted((start for start in self.segments.keys()
+                       if start <= to and start + self.window > since), reverse = True)
+
+    def segmentFile(self, start):
+        return os.path.join(self.segmentDir(), "{}.db".format(start))
+
+    @staticmethod
+    def segmentDir():
+        return os.path.join(config.workDir, "segments")
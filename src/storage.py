@@ -1,241 +1,254 @@
-import os, sys, sqlite3, logging, time
-from os import path
+import os, sqlite3, logging, time, hashlib
+from contextlib import contextmanager
 
-import config
-from config import genConnId
+import config, schema
+from backend import Backend, StorageTimeout
+from database import Database
 
 log = logging.getLogger("storage")
-VAC_BATCH = 1024
+JOURNAL_MODES = ("delete", "truncate", "persist", "memory", "wal", "off")
+SYNCHRONOUS = ("off", "normal", "full", "extra")
+SELECT = ("SELECT p.timestamp, coalesce(p.data, b.data), coalesce(b.codec, p.codec), p.id " +
+          "FROM packets p LEFT JOIN blobs b ON b.hash = p.hash ")
 
-class StorageTimeout(Exception): pass
 
-class Storage:
-    def __init__(self):
-        self.dbLock = False
-        
-        conf = config.getSub("storage")
-        self.capacity = conf.get("capacity", cast = config.positiveInt, default = 2048)
-        self.vacPercent = conf.get("vacuum_percent", cast = config.positivePercent, default = 20.0) / 100
-        self.timeout = conf.get("timeout", cast = config.positiveFloat, default = 10.0)
-        
+class Storage(Backend):
+    """SQLite backend: a single eris.db in the work directory."""
+    def configure(self, conf):
+        self.readers = conf.get("readers", cast = config.positiveInt, default = 4)
+        self.pragmas = [
+            ("journal_mode", conf.get("journal_mode", cast = config.choice(*JOURNAL_MODES), default = "wal")),
+            ("synchronous", conf.get("synchronous", cast = config.choice(*SYNCHRONOUS), default = "normal")),
+            ("cache_size", conf.get("cache_size", cast = int, default = -2000)),
+            ("mmap_size", conf.get("mmap_size", cast = config.nonNegativeInt, default = 0)),
+        ]
+        self.retentionChunk = conf.get("retention_chunk", cast = config.positiveInt, default = 512)
+        self.retentionBudget = conf.get("retention_budget_ms", cast = config.positiveFloat, default = 100.0) / 1000
+        self.vacuumPages = conf.get("vacuum_pages", cast = config.positiveInt, default = 256)
+        self.dedup = conf.get("dedup", cast = config.boolean, default = False)
+    
+    def open(self):
+        self.db = self.openDb(self.dbFile(), self.readers)
+        self.stats = self.loadStats(self.db.writer)
+    
+    def openDb(self, dbFile, readers):
+        conn = sqlite3.connect(dbFile, isolation_level = None)
         try:
-            conn = sqlite3.connect(self.dbFile())
-            with conn:
-                conn.execute("CREATE TABLE IF NOT EXISTS packets (timestamp INT8, data BLOB)")
-            self.vaccum()
-        except Exception:
-            log.critical("Failed to initialize database", exc_info = 1)
-            sys.exit(1)
-        
-        self.connections = {}
-        self.connectionId = genConnId()
-        log.info("Database initialized")
+            schema.migrate(conn)
+        finally:
+            conn.close()
+        return Database(dbFile, self.pragmas, readers, self.timeout)
+    
+    def closeStore(self):
+        self.db.close()
         
     def vaccum(self):
-        if self.size() >= self.capacity:
-            log.debug("Size: {}, Capacity: {}".format(self.size(), self.capacity))
-            try:
-                self.waitForLock()
-                self.dbLock = True
-                
-                cutoff = 0
-                count = self.rowcount()
-                
-                with sqlite3.connect(self.dbFile()) as conn:
-                    log.info("Vacuuming storage. About to delete {}% packets".format(self.vacPercent * 100))
-                    conn = sqlite3.connect(self.dbFile())
-                    c = conn.cursor()
-                    c.execute("SELECT timestamp FROM packets ORDER BY timestamp ASC")
-                    if count <= 0:
-                        log.error("Storage size is over limit, but there are no packets. Verify configuration")
-                        return
-                    found = 0
-                    while True:
-                        ts = c.fetchmany(VAC_BATCH)
-                        if len(ts) == 0:
-                            break
-                        if float(found + len(ts)) / count >= self.vacPercent:
-                            x = int(count * self.vacPercent - found)
-                            if x < 0:
-                                x = 0
-                            if x >= len(ts):
-                                x = -1
-                            cutoff = ts[x][0]
-                            break
-                        else:
-                            found += len(ts)
-                            cutoff = ts[-1][0]
-                    c.execute("DELETE FROM packets WHERE timestamp <= ?", (long(cutoff), ))
-                    log.info("Deleting packets with timestamp <= {}. In total {} out of {}".format(cutoff, c.rowcount, count))
-                    conn.commit()
-                
-                with sqlite3.connect(self.dbFile()) as conn:
-                    conn.execute("VACUUM")
-                    conn.commit()
+        """Deletes the oldest vacuum_percent of packets once storage exceeds capacity.
 
-            except:
-                log.error("Vacuuming database failed", exc_info = 1)
-            finally:
-                self.dbLock = False
-                log.debug("Size: {}, Capacity: {}".format(self.size(), self.capacity))
-    
-    def size(self):
-        try:
-            return path.getsize(self.dbFile()) / 1024
-        except:
-            return 0
-        
-    def put(self, packets):
-        log.info("Inserting {} packets".format(len(packets)))
-        try:
-            self.waitForLock()
-            
-            conn = sqlite3.connect(self.dbFile())
-            with conn:
-                for p in packets:
-                    packet = (long(time.time() * 1000) if p[0] is None else long(p[0]), buffer(p[1]))
-                    conn.execute("INSERT INTO packets VALUES(?, ?)", packet)
-                conn.commit()
-            self.vaccum()
-        except Exception:
-            log.error("Failed to insert packets into db", exc_info = 1)
-            
-    def get(self, since = 0, to = 0, limit = 0):
+        The work is split into steps (chunked deletes, then incremental_vacuum
+        of freed pages); each step holds the writer lock for at most the
+        retention budget, so readers and other writers interleave with it.
+        """
+        if not self.overCapacity():
+            return
         try:
-            self.waitForLock()
-            
-            to = long(to) if to > 0 else long(2 ** 63 - 1)
-            since = long(since)
+            cutoff = self.cutoff()
+            if cutoff is None:
+                return
             
-            log.info("Retrieving packets (since={}, to={}, limit={})".format(since, to, limit))
+            deleted = [0]
+            def deleteChunk(conn):
+                with conn:
+                    n = self.deleteWhere(conn, "id IN (SELECT id FROM packets " +
+                                         "WHERE timestamp <= ? AND (timestamp < ? OR id <= ?) " +
+                                         "ORDER BY timestamp ASC LIMIT ?)", cutoff + (self.retentionChunk, ))
+                    self.forget((cutoff[0], cutoff[2]))
+                    self.stats = self.loadStats(conn)
+                deleted[0] += n
+                return n >= self.retentionChunk
             
-            conn = sqlite3.connect(self.dbFile())
-            cursor = conn.cursor()
+            while self.step(deleteChunk):
+                pass
+            log.info("Deleted {} packets with timestamp <= {}".format(deleted[0], cutoff[0]))
             
-            if limit > 0:
-                cursor.execute("SELECT count(*) FROM packets WHERE timestamp > ? AND timestamp < ? LIMIT ?", 
-                          (since, to, limit))
-                count = cursor.fetchone()[0]
-                cursor.execute("SELECT timestamp, data FROM packets WHERE timestamp > ? AND timestamp < ?" + 
-                               "ORDER BY timestamp DESC LIMIT ?", (since, to, limit))
-            else:
-                cursor.execute("SELECT count(*) FROM packets WHERE timestamp > ? AND timestamp < ?", 
-                          (since, to))
-                count = cursor.fetchone()[0]
-                cursor.execute("SELECT timestamp, data FROM packets WHERE timestamp > ? AND timestamp < ? " + 
-                               "ORDER BY timestamp DESC", (since, to))
-            connId = self.connectionId.next()
-            self.connections[connId] = (conn, cursor)
-            return connId, count
-            
-        except Exception:
-            log.error("Failed to retrieve packets from db", exc_info = 1)
-            return None, 0
-        
-    def closeConn(self, connId):
-        (conn, _) = self.connections.get(connId, (None, None))
-        if conn is None:
-            return
-        try:
-            del self.connections[connId]
-            conn.close()
+            while self.step(self.reclaim):
+                pass
         except:
-            log.warn("Error closing connection to db", exc_info = 1)
-        
-        
-    def rowcount(self):
+            log.error("Vacuuming database failed", exc_info = 1)
+        finally:
+            log.debug("Size: {}, Packets: {}, Bytes: {}".format(self.size(), self.stats["rows"], self.stats["bytes"]))
+    
+    def cutoff(self):
+        with self.writing():
+            conn = self.db.writer
+            count = self.stats["rows"]
+            if count <= 0:
+                log.error("Storage size is over limit, but there are no packets. Verify configuration")
+                return None
+            log.info("Vacuuming storage. About to delete {}% packets".format(self.vacPercent * 100))
+            n = max(int(count * self.vacPercent), 1)
+            row = conn.execute("SELECT timestamp, id FROM packets ORDER BY timestamp ASC, id ASC LIMIT 1 OFFSET ?",
+                               (n - 1, )).fetchone()
+            if row is None:
+                return None
+            return (row[0], row[0], row[1])
+    
+    def reclaim(self, conn):
+        conn.execute("PRAGMA incremental_vacuum({})".format(self.vacuumPages)).fetchall()
+        return conn.execute("PRAGMA freelist_count").fetchone()[0] > 0
+    
+    def step(self, work):
+        """Repeats work under a single writer lock acquisition until it is done
+        or the retention budget is spent. Returns True if work remains."""
+        with self.writing():
+            deadline = time.time() + self.retentionBudget
+            while work(self.db.writer):
+                if time.time() >= deadline:
+                    return True
+            return False
+    
+    def size(self):
         try:
-            conn = sqlite3.connect(self.dbFile())
-            c = conn.cursor()
-            c.execute("SELECT count(*) FROM packets")
-            count = c.fetchone()[0]
-            conn.close()
-            return count
+            with self.reader(self.db) as conn:
+                return self.usedKiB(conn)
         except:
-            log.error("Failed to retrieve packet count", exc_info = 1)
+            log.warn("Failed to evaluate storage size", exc_info = 1)
             return 0
-
-        
-    def fetch(self, connId, n = 1):
-        (conn, cursor) = self.connections.get(connId, (None, None))
-        if conn is None:
-            return []
-
-        try:
-            result = cursor.fetchmany(size = n)
-            if result is None or len(result) == 0:
-                self.closeConn(connId)
-                return []
-            else:
-                log.debug("Fetched {} packets".format(len(result)))
-                return self.debuffer(result)
-        except Exception:
-            log.exception("Failed to fetch packets from db")
-            self.closeConn(connId)
-            return []
-    
-    def fetchall(self, connId):
-        (conn, cursor) = self.connections.get(connId, (None, None))
+    
+    def encode(self, packets):
+        return [(t, ) + self.codec.encode(d) + (hashlib.sha1(d).digest() if self.dedup else None, )
+                for t, d in packets]
+    
+    def write(self, packets):
+        with self.db.writer as conn:
+            seqs = self.insertRows(conn, packets)
+            self.stats = self.loadStats(conn)
+            return seqs
+    
+    def count(self, since, to, limit):
+        count = self.spanned(self.stats, since, to)
+        if count is not None:
+            return min(count, limit) if limit > 0 else count
+        with self.reader(self.db) as conn:
+            return self.countRange(conn, since, to, limit)
+    
+    def page(self, since, to, after, n):
+        with self.reader(self.db) as conn:
+            return self.selectPage(conn, since, to, after, n)
+    
+    def totals(self):
+        """Packet count, payload bytes and timestamp bounds, kept up to date by
+        every write transaction."""
+        return self.stats
+    
+    def remove(self, since, to):
+        with self.db.writer as conn:
+            count = self.deleteRange(conn, since, to)
+            self.stats = self.loadStats(conn)
+            return count
+    
+    def acquireReader(self, db):
+        conn = db.acquireReader(self.timeout)
         if conn is None:
-            return []
-
-        try:
-            result = cursor.fetchall()
-            log.debug("Fetched {} packets".format(len(result)))
-            return self.debuffer(result)
-        except Exception:
-            log.exception("Failed to fetch packets from db")
-            return []
-        finally:
-            self.closeConn(connId)
-            
+            raise StorageTimeout("No database connection available")
+        return conn
     
-    def delete(self, since, to):
+    @contextmanager
+    def reader(self, db):
+        conn = self.acquireReader(db)
         try:
-            self.waitForLock()
-            self.dbLock = True
-            
-            to = long(to) if to > 0 else long(2 ** 63 - 1)
-            since = long(since)
-            log.info("Deleting packets (since={}, to={})".format(since, to))
-            
-            with sqlite3.connect(self.dbFile()) as conn:
-                conn = sqlite3.connect(self.dbFile())
-                c = conn.cursor()
-                c.execute("DELETE FROM packets WHERE timestamp >= ? AND timestamp <= ?", (since, to))
-                count = c.rowcount
-                conn.commit()
-                log.info("Deleted {} packets".format(count))
-        except:
-            log.exception("Could not delete sent packets")
+            yield conn
         finally:
-            self.dbLock = False
-        
-    def release(self, connId):
-        if connId in self.connections:
-            (conn, _) = self.connections.get(connId, (None, None))
-            if conn is not None:
-                try:
-                    conn.close()
-                except:
-                    pass
-            del self.connections[connId]
-            
-    def waitForLock(self):
-        t0 = time.time()
-        tau = 0.0
-        dt = 0.05
-        while self.dbLock:
-            time.sleep(dt)
-            tau += dt
-            if tau >= 1.0:
-                log.info("Waiting for database")
-                tau = 0.0
-            if time.time() - t0 > self.timeout:
-                raise StorageTimeout("Database request timed out")
-    
-    def debuffer(self, result):
-        return [(t, str(d)) for t, d in result]
+            db.releaseReader(conn)
+    
+    @staticmethod
+    def insertRows(conn, packets):
+        """Inserts encoded packets and returns their ids. The table has no
+        AUTOINCREMENT, so new rows take consecutive ids after the largest one."""
+        last = conn.execute("SELECT coalesce(max(id), 0) FROM packets").fetchone()[0]
+        conn.executemany("INSERT INTO packets (timestamp, codec, data, hash) VALUES(?, ?, ?, ?)",
+                         ((t, c, None, buffer(h)) if h else (t, c, buffer(d), None) for t, c, d, h in packets))
+        size = (sum(len(d) for _, _, d, h in packets if h is None) +
+                Storage.shareBlobs(conn, [p for p in packets if p[3] is not None]))
+        timestamps = [p[0] for p in packets]
+        conn.execute("UPDATE meta SET value = value + ? WHERE key = 'rows'", (len(packets), ))
+        conn.execute("UPDATE meta SET value = value + ? WHERE key = 'bytes'", (size, ))
+        conn.execute("UPDATE meta SET value = min(coalesce(value, ?), ?) WHERE key = 'min_ts'", (min(timestamps), ) * 2)
+        conn.execute("UPDATE meta SET value = max(coalesce(value, ?), ?) WHERE key = 'max_ts'", (max(timestamps), ) * 2)
+        return range(last + 1, last + 1 + len(packets))
+    
+    @staticmethod
+    def shareBlobs(conn, packets):
+        """Stores each distinct payload once in blobs, adding a reference per
+        packet. Returns the number of newly stored bytes. Unreferenced blobs
+        are removed by the packets_unref trigger."""
+        refs = {}
+        blobs = {}
+        for _, c, d, h in packets:
+            refs[h] = refs.get(h, 0) + 1
+            blobs[h] = (c, d)
+        hashes = refs.keys()
+        existing = set()
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            existing.update(str(h) for (h, ) in conn.execute("SELECT hash FROM blobs WHERE hash IN ({})".format(
+                ", ".join("?" * len(chunk))), [buffer(h) for h in chunk]))
+        new = [h for h in hashes if h not in existing]
+        conn.executemany("INSERT INTO blobs (hash, codec, data, refs) VALUES (?, ?, ?, ?)",
+                         ((buffer(h), blobs[h][0], buffer(blobs[h][1]), refs[h]) for h in new))
+        conn.executemany("UPDATE blobs SET refs = refs + ? WHERE hash = ?",
+                         ((refs[h], buffer(h)) for h in existing))
+        return sum(len(blobs[h][1]) for h in new)
+    
+    @staticmethod
+    def deleteRange(conn, since, to):
+        return Storage.deleteWhere(conn, "timestamp >= ? AND timestamp <= ?", (since, to))
+    
+    @staticmethod
+    def deleteWhere(conn, where, params):
+        rows, size = conn.execute("SELECT count(*), coalesce(sum(length(data)), 0) FROM packets WHERE " + where,
+                                  params).fetchone()
+        if rows == 0:
+            return 0
+        conn.execute("DELETE FROM packets WHERE " + where, params)
+        conn.execute("UPDATE meta SET value = value - ? WHERE key = 'rows'", (rows, ))
+        conn.execute("UPDATE meta SET value = value - ? WHERE key = 'bytes'", (size, ))
+        conn.execute("UPDATE meta SET value = (SELECT min(timestamp) FROM packets) WHERE key = 'min_ts'")
+        conn.execute("UPDATE meta SET value = (SELECT max(timestamp) FROM packets) WHERE key = 'max_ts'")
+        return rows
+    
+    @staticmethod
+    def loadStats(conn):
+        return dict(conn.execute("SELECT key, value FROM meta"))
+    
+    @staticmethod
+    def countRange(conn, since, to, limit):
+        """Counts packets of (since, to) on packets_timestamp alone, stopping
+        after limit of them when a limit is given."""
+        if limit > 0:
+            return conn.execute("SELECT count(*) FROM (SELECT 1 FROM packets " +
+                                "WHERE timestamp > ? AND timestamp < ? LIMIT ?)",
+                                (since, to, limit)).fetchone()[0]
+        else:
+            return conn.execute("SELECT count(*) FROM packets WHERE timestamp > ? AND timestamp < ?", 
+                                (since, to)).fetchone()[0]
+    
+    @staticmethod
+    def selectPage(conn, since, to, after, n):
+        """Up to n packets of (since, to) ordered below the (timestamp, id) key
+        after, newest first. Walks packets_timestamp, which also holds the id."""
+        lastTs, lastId = after
+        return conn.execute(SELECT + "WHERE p.timestamp > ? AND p.timestamp < ? AND p.timestamp <= ? " +
+                            "AND (p.timestamp < ? OR p.id < ?) " +
+                            "ORDER BY p.timestamp DESC, p.id DESC LIMIT ?",
+                            (since, to, lastTs, lastTs, lastId, n)).fetchall()
+    
+    @staticmethod
+    def usedKiB(conn):
+        pageSize = conn.execute("PRAGMA page_size").fetchone()[0]
+        pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * pageSize / 1024
     
     @staticmethod    
     def dbFile():
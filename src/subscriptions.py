@@ -0,0 +1,81 @@
+import threading, logging
+
+log = logging.getLogger("storage")
+
+
+class Subscription:
+    """Packets stored after a client subscribed, waiting to be pushed to it.
+
+    Storage hands every committed batch to notify, with its write lock held;
+    the packets within (since, to) are queued until the connection takes
+    them, and the connection is woken through `ready` or, for the reactor,
+    the listener callback. A subscriber which lets more than `capacity` bytes
+    pile up is dropped: take returns None and the client has to catch up
+    with a regular request.
+    """
+    def __init__(self, since, to, capacity, listener = None):
+        self.since = long(since)
+        self.to = long(to) if to > 0 else long(2 ** 63 - 1)
+        self.capacity = capacity
+        self.listener = listener
+        self.packets = []
+        self.bytes = 0
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+
+    def notify(self, packets):
+        matching = [(t, d) for t, d in packets if self.since < t < self.to]
+        if not matching:
+            return
+        with self.lock:
+            if self.packets is None:
+                return
+            self.packets.extend(matching)
+            self.bytes += sum(len(d) for _, d in matching)
+            if self.bytes > self.capacity:
+                log.warn("Subscriber fell {} bytes behind, dropping it".format(self.bytes))
+                self.packets = None
+        self.ready.set()
+        if self.listener is not None:
+            self.listener()
+
+    def wait(self, timeout):
+        return self.ready.wait(timeout)
+
+    def take(self):
+        """(timestamp, data) packets queued since the last call, or None if
+        the subscriber fell too far behind."""
+        with self.lock:
+            self.ready.clear()
+            packets = self.packets
+            if packets is not None:
+                self.packets = []
+                self.bytes = 0
+            return packets
+
+
+class Subscriptions:
+    """Subscriptions registered with a storage backend."""
+    def __init__(self):
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+
+    def add(self, subscription):
+        with self.lock:
+            self.subscriptions.add(subscription)
+
+    def remove(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def notify(self, packets):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            try:
+                subscription.notify(packets)
+            except Exception:
+                log.exception("Failed to notify subscriber")
+
+    def __len__(self):
+        return len(self.subscriptions)
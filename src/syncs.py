@@ -0,0 +1,40 @@
+import threading, logging
+
+from database import Database
+
+log = logging.getLogger("storage")
+
+
+class SyncCursors:
+    """High-water marks of client syncs: for every client address, the newest
+    timestamp of a transfer the client confirmed with the final count.
+
+    Marks are kept in their own SQLite file, whichever storage backend is in
+    use, and cached in memory. Callers read them on every request, they are
+    only written when a transfer completes.
+    """
+    def __init__(self, dbFile, timeout = 10.0):
+        self.lock = threading.Lock()
+        self.db = Database(dbFile, [("synchronous", "full")], 1, timeout)
+        with self.db.writer as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS syncs (address TEXT PRIMARY KEY, timestamp INT8 NOT NULL)")
+        self.marks = dict(self.db.writer.execute("SELECT address, timestamp FROM syncs").fetchall())
+        log.info("Loaded sync cursors of {} clients".format(len(self.marks)))
+
+    def get(self, address):
+        with self.lock:
+            return self.marks.get(address)
+
+    def advance(self, address, timestamp):
+        """Raises the mark of a client to timestamp. Returns whether it moved."""
+        with self.lock:
+            current = self.marks.get(address)
+            if current is not None and timestamp <= current:
+                return False
+            with self.db.writer as conn:
+                conn.execute("INSERT OR REPLACE INTO syncs (address, timestamp) VALUES (?, ?)", (address, timestamp))
+            self.marks[address] = timestamp
+            return True
+
+    def close(self):
+        self.db.close()
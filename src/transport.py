@@ -0,0 +1,105 @@
+import os, socket, logging
+
+import config
+
+log = logging.getLogger("btserver")
+TRANSPORTS = ("rfcomm", "tcp", "unix")
+
+
+def create(conf):
+    name = conf.get("transport", cast = config.choice(*TRANSPORTS), default = "rfcomm")
+    if name == "tcp":
+        return TcpTransport(conf.get("tcp_host", default = "127.0.0.1"),
+                            conf.get("tcp_port", cast = config.port, default = 7018))
+    elif name == "unix":
+        return UnixTransport(conf.get("unix_socket", cast = config.directory,
+                                      default = os.path.join(config.workDir, "eris.sock")))
+    else:
+        return RfcommTransport(conf.get("rfcomm_channel", cast = config.channel, default = 2))
+
+
+class Transport:
+    """Listening socket the bluetooth protocol is served on.
+
+    RFCOMM is what handhelds connect to; TCP and Unix domain sockets carry
+    the same framed protocol so the server can be driven and profiled
+    without radios. Listening sockets are non-blocking.
+
+        listen(backlog)     bind and return the listening socket
+        accepted(sock)      prepare an accepted client socket
+        address(info)       client address from what accept returned
+        close(sock)         close the listening socket
+    """
+    def listen(self, backlog):
+        raise NotImplementedError()
+
+    def accepted(self, sock):
+        pass
+
+    def address(self, info):
+        return info[0]
+
+    def close(self, sock):
+        sock.close()
+
+
+class RfcommTransport(Transport):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def listen(self, backlog):
+        import bluetooth as bt
+        sock = bt.BluetoothSocket(bt.RFCOMM)
+        sock.setblocking(0)
+        sock.bind(("", self.channel))
+        sock.listen(1)
+        bt.advertise_service(sock, config.PNAME,
+                  service_classes = [bt.SERIAL_PORT_CLASS],
+                  profiles = [bt.SERIAL_PORT_PROFILE])
+        log.info("Waiting for connections on RFCOMM channel [{}]".format(sock.getsockname()[1]))
+        return sock
+
+
+class TcpTransport(Transport):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def listen(self, backlog):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setblocking(0)
+        sock.bind((self.host, self.port))
+        sock.listen(backlog)
+        log.info("Waiting for connections on TCP {}:{}".format(*sock.getsockname()))
+        return sock
+
+    def accepted(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class UnixTransport(Transport):
+    """Unix domain socket. All its clients share one address, and so one
+    checkpoint and one sync mark."""
+    def __init__(self, path):
+        self.path = path
+
+    def listen(self, backlog):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sock.bind(self.path)
+        sock.listen(backlog)
+        log.info("Waiting for connections on {}".format(self.path))
+        return sock
+
+    def address(self, info):
+        return "unix:" + self.path
+
+    def close(self, sock):
+        sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,73 @@
+import struct
+
+# Protobuf wire encoding of bt.proto Response frames, built from pre-encoded
+# Packet fields instead of going through bt_pb2 objects. Frames are lists of
+# segments (str or buffer) so payloads are sent without being copied.
+
+FIXED64 = struct.Struct("<Q")
+
+RESPONSE_FRM = "\x09"       # Response.frm, fixed64
+RESPONSE_TO = "\x11"        # Response.to, fixed64
+RESPONSE_PACKET = "\x1a"    # Response.packets, length delimited
+RESPONSE_COUNT = "\x20"     # Response.noPackets, varint
+RESPONSE_COMPRESSED = "\x32"  # Response.compressed, length delimited
+RESPONSE_CODEC = "\x38"     # Response.codec, varint
+PACKET_TIMESTAMP = "\x09"   # Packet.timestamp, fixed64
+PACKET_DATA = "\x12"        # Packet.data, length delimited
+
+
+def varint(n):
+    out = []
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(chr(byte | 0x80))
+        else:
+            out.append(chr(byte))
+            return "".join(out)
+
+
+def dataField(data):
+    """Encodes a payload as the Packet.data field."""
+    return dataHeader(data) + data
+
+
+def dataHeader(data):
+    return PACKET_DATA + varint(len(data))
+
+
+def payload(field):
+    """Payload of an encoded Packet.data field."""
+    i = 1
+    while ord(field[i]) & 0x80:
+        i += 1
+    return field[i + 1:]
+
+
+def packet(ts, field, full):
+    """Segments of the Response.packets entry for a Packet.data field given
+    as a tuple of segments."""
+    size = sum(len(s) for s in field)
+    if full:
+        return (RESPONSE_PACKET + varint(size + 9) + PACKET_TIMESTAMP + FIXED64.pack(ts), ) + field
+    return (RESPONSE_PACKET + varint(size), ) + field
+
+
+def response(packets, full, noPackets = None):
+    """Segments of the Response for (timestamp, data field) packets, newest
+    first. Joined, they equal what bt_pb2 serializes for the same message."""
+    segments = []
+    if packets and not full:
+        segments.append(RESPONSE_FRM + FIXED64.pack(packets[-1][0]))
+        segments.append(RESPONSE_TO + FIXED64.pack(packets[0][0]))
+    for ts, field in packets:
+        segments.extend(packet(ts, field, full))
+    if noPackets is not None:
+        segments.append(RESPONSE_COUNT + varint(noPackets))
+    return segments
+
+
+def compressed(data, codec):
+    """Segments of a Response wrapping a compressed Response."""
+    return [RESPONSE_COMPRESSED + varint(len(data)), data, RESPONSE_CODEC + varint(codec)]